@@ -0,0 +1,183 @@
+import asyncio
+
+try:
+    # If we can, Use uvloop as a faster event loop.
+    import uvloop
+except:
+    uvloop = None
+
+class TransportSocket:
+    """
+    Socket-like wrapper around an asyncio transport.
+    The handlers keep calling send(), recv() and close() like they would on
+    a raw socket, but writes never block and reads come from the protocol.
+    """
+    def __init__(self, reactor, transport):
+        self.reactor = reactor
+        self.transport = transport
+
+        # Data received by the protocol but not read yet.
+        self.inbox = bytearray()
+        self.closed = False
+
+        # Why we stopped reading ("queue" for our send queue, "transport" for its flow control),
+        # we only read again once none of them holds.
+        self.readPauses = set()
+
+        self.onRead = None
+
+    def notify(self):
+        if self.onRead:
+            self.onRead()
+
+    def send(self, data):
+        if self.closed or self.transport.is_closing():
+            raise ConnectionResetError("Transport is closed")
+
+        # The transport can keep a reference to what we give it,
+        # and our caller changes its buffer as soon as we return.
+        self.transport.write(bytes(data))
+        return len(data)
+
+    def recv(self, bufsize):
+        data = bytes(self.inbox[:bufsize])
+        del self.inbox[:bufsize]
+
+        # We still have data (or the end of the stream) for the next read.
+        if self.inbox or self.closed:
+            self.reactor.callSoon(self.notify)
+
+        return data
+
+    def recv_into(self, buffer):
+        size = min(len(buffer), len(self.inbox))
+        buffer[:size] = self.inbox[:size]
+        del self.inbox[:size]
+
+        if self.inbox or self.closed:
+            self.reactor.callSoon(self.notify)
+
+        return size
+
+    def pauseReading(self, reason):
+        if not self.readPauses and not self.transport.is_closing():
+            self.transport.pause_reading()
+
+        self.readPauses.add(reason)
+
+    def resumeReading(self, reason):
+        if not reason in self.readPauses:
+            return
+
+        self.readPauses.remove(reason)
+        if not self.readPauses and not self.transport.is_closing():
+            self.transport.resume_reading()
+
+    def setblocking(self, flag):
+        pass
+
+    def close(self):
+        self.transport.close()
+
+    def __repr__(self):
+        return "<TransportSocket %s>" % (str(self.transport.get_extra_info("peername")))
+
+class StreamProtocol(asyncio.Protocol):
+    def __init__(self, reactor, onAccept):
+        self.reactor = reactor
+        self.onAccept = onAccept
+        self.sock = None
+
+    def connection_made(self, transport):
+        self.sock = TransportSocket(self.reactor, transport)
+        self.onAccept(self.sock, transport.get_extra_info("peername"))
+
+    def data_received(self, data):
+        self.sock.inbox += data
+        self.sock.notify()
+
+    def connection_lost(self, exc):
+        # Reading from a closed socket will return nothing, so the client gets dropped.
+        self.sock.closed = True
+        self.sock.notify()
+
+    def pause_writing(self):
+        # The peer isn't reading fast enough,
+        # we stop reading from it until it catches up.
+        self.sock.pauseReading("transport")
+
+    def resume_writing(self):
+        self.sock.resumeReading("transport")
+
+class DatagramProtocol(asyncio.DatagramProtocol):
+    def __init__(self, onData):
+        self.onData = onData
+
+    def datagram_received(self, data, addr):
+        self.onData(data)
+
+class AsyncioTimer:
+    def __init__(self, loop, delay, callback, repeat):
+        self.loop = loop
+        self.delay = delay
+        self.callback = callback
+        self.repeat = repeat
+        self.handle = self.loop.call_later(delay, self.fire)
+
+    def fire(self):
+        if self.repeat:
+            self.handle = self.loop.call_later(self.delay, self.fire)
+
+        self.callback()
+
+    def cancel(self):
+        self.handle.cancel()
+
+class AsyncioReactor:
+    """
+    Same interface as Reactor, but running on an asyncio event loop
+    (uvloop if it's available), with asyncio Protocols for every socket.
+    """
+    def __init__(self, useUvloop=True):
+        if useUvloop and uvloop:
+            self.loop = uvloop.new_event_loop()
+        else:
+            self.loop = asyncio.new_event_loop()
+
+        asyncio.set_event_loop(self.loop)
+
+    def register(self, sock, onRead):
+        sock.onRead = onRead
+
+    def listen(self, sock, onAccept):
+        self.loop.run_until_complete(self.loop.create_server(lambda: StreamProtocol(self, onAccept), sock=sock))
+
+    def listenDatagram(self, sock, onData):
+        self.loop.run_until_complete(self.loop.create_datagram_endpoint(lambda: DatagramProtocol(onData), sock=sock))
+
+    def unregister(self, sock):
+        sock.onRead = None
+
+    def setWriter(self, sock, onWrite):
+        # Transports buffer and flush writes by themselves.
+        pass
+
+    def setReading(self, sock, reading):
+        if reading:
+            sock.resumeReading("queue")
+        else:
+            sock.pauseReading("queue")
+
+    def callSoon(self, callback):
+        self.loop.call_soon(callback)
+
+    def addTimer(self, delay, callback, repeat=False):
+        return AsyncioTimer(self.loop, delay, callback, repeat)
+
+    def poll(self, timeout=None):
+        # Run a single iteration of the loop.
+        self.loop.call_soon(self.loop.stop)
+        self.loop.run_forever()
+
+    def run(self):
+        self.loop.run_forever()
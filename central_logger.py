@@ -1,8 +1,10 @@
 from panda3d.core import Datagram
-from panda3d.direct import DCPacker
+from packer_pool import packerPool
 from distributed_object import DistributedObject
 
 class CentralLogger(DistributedObject):
+    __slots__ = ("otp", "eventServer")
+    
     def __init__(self, otp, doId, dclass, parentId, zoneId):
         super().__init__(doId, dclass, parentId, zoneId)
         
@@ -12,20 +14,19 @@ class CentralLogger(DistributedObject):
         # Quick access for ES
         self.eventServer = self.otp.eventServer
 
-    def receiveField(self, sender, field, di):
+    def logField(self, sender, field, data):
         # We don't want a molecular field update.
         molecular = field.asMolecularField()
         if molecular: return
         
-        packer = DCPacker()
-        packer.setUnpackData(di.getRemainingBytes())
+        packer = packerPool.get()
+        packer.setUnpackData(data)
         
         packer.beginUnpack(field)
         value = field.unpackArgs(packer)
         category, eventString, targetDISLId, targetAvId = value
         
         packer.endUnpack()
-            
-        di.skipBytes(packer.getNumUnpackedBytes())
+        packerPool.release(packer)
         
         self.eventServer.writeToLog("%d|%s|%s|%d|%d\n" % (sender, category, eventString, targetDISLId, targetAvId))
\ No newline at end of file
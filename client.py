@@ -1,9 +1,9 @@
-import math, os, struct, time, pytz, traceback
+import math, os, time, pytz, traceback
 from datetime import datetime, timezone
 
 from panda3d.core import Datagram, DatagramIterator
 from panda3d.direct import DCPacker
-from zone_util import getCanonicalZoneId, getTrueZoneId
+from framing import FrameDecoder, SendQueue
 from msgtypes import *
 from security import *
 
@@ -20,7 +20,8 @@ class Client:
         self.stateServer = self.otp.stateServer
 
         # State stuff
-        self.buffer = bytearray()
+        self.decoder = FrameDecoder()
+        self.sendQueue = SendQueue(sock, self.otp.reactor, self.otp.sendQueueHighWater)
         self.interests = {}
 
         # Account stuff
@@ -30,11 +31,12 @@ class Client:
         # This is for if we're authorized or not yet. Some messages can only be sent when authorized.
         self.__authorized = False
 
-        # Cache for interests, so we don't have to iterate through all interests
-        # every time an object updates.
-        # This could be optimized in other languages, but we're using Python so
-        # we're just gonna use a set
-        self.__interestCache = set()
+        # The account we keep in the database cache while we're connected.
+        self.__pinnedAccountId = 0
+
+        # How many of our interests include each location, (parentId, zoneId) -> count,
+        # so we don't have to iterate through all interests every time an object updates.
+        self.__interestCounts = {}
 
         # This is used to store the clsend field overrides sent by CLIENT_SET_FIELD_SENDABLE.
         self.__doId2ClsendOverrides = {}
@@ -52,39 +54,50 @@ class Client:
         # We are no longer authorized.
         self.__authorized = False
         
-        # Now we disconnect the client
-        self.sock.close()
+        # Now we delete the client from OTP, our queue disconnects it
+        # once what's left in it (our CLIENT_GO_GET_LOST) is sent.
+        self.sendQueue.close()
+        self.otp.removeClient(self.sock)
 
         # This is not gonna call itself
         self.onLost()
 
-        # Now we delete the client from OTP
-        del self.otp.clients[self.sock]
-        self.agent.clients.remove(self)
-
     def onAvatarDelete(self):
         # Our avatar got deleted
+        self.agent.avatars.pop(self.avatarId, None)
         self.avatarId = 0
         self.disconnect(153, "Lost connection.")
 
     def onLost(self):
+        # We save our account and avatar right away when we're done with them.
+        doIds = []
+        if self.avatarId:
+            doIds.append(self.avatarId)
+        if self.account:
+            doIds.append(self.account.doId)
+
         # We remove the avatar if we're disconnecting. Bye!
         if self.avatarId:
             self.removeAvatar()
 
+        # We're not interested in anything anymore.
+        for parentId, zones in self.interests.values():
+            self.removeInterestZones(parentId, zones)
+
+        self.interests.clear()
+
         # We are no longer authorized.
         self.__authorized = False
 
-    def onData(self, data):
-        self.buffer += data
-        while len(self.buffer) >= 2:
-            length = struct.unpack("<H", self.buffer[:2])[0]
-            if len(self.buffer) < length+2:
-                break
+        # Our account can leave the database cache.
+        if self.__pinnedAccountId:
+            self.databaseServer.manager.unpinDatabaseObject(self.__pinnedAccountId)
+            self.__pinnedAccountId = 0
 
-            packet = self.buffer[2:length+2]
-            self.buffer = self.buffer[length+2:]
+        self.databaseServer.manager.flushDatabaseObjects(doIds)
 
+    def onData(self, data):
+        for packet in self.decoder.feed(data):
             self.onDatagram(Datagram(bytes(packet)))
 
     def onDatagram(self, msgDg):
@@ -188,7 +201,9 @@ class Client:
                 accountDays = abs(delta_time.days)
                  
             # If no errors occurred and we got our account, Then we authorize this client to use the other messages.
-            if returnCode == 0 and self.account: self.__authorized = True
+            if returnCode == 0 and self.account:
+                self.__authorized = True
+                self.pinAccount()
 
             datagram = Datagram()
             datagram.addInt8(returnCode) # returnCode
@@ -311,7 +326,9 @@ class Client:
                 
             
             # If no errors occurred and we got our account, Then we authorize this client to use the other messages.
-            if returnCode == 0 and self.account: self.__authorized = True
+            if returnCode == 0 and self.account:
+                self.__authorized = True
+                self.pinAccount()
             print(returnCode, self.account, self.__authorized)
 
             datagram = Datagram()
@@ -550,90 +567,29 @@ class Client:
                     # No we don't want you Quiet Zone
                     continue
 
-                zones.add(zoneId)
+                # We add the zone and its visibles
+                zones |= self.agent.expandZone(zoneId)
 
-                # We add visibles
-                canonicalZoneId = getCanonicalZoneId(zoneId)
-
-                if canonicalZoneId in self.agent.visgroups:
-                    for visZoneId in self.agent.visgroups[canonicalZoneId]:
-                        zones.add(getTrueZoneId(visZoneId, zoneId))
-
-                    # We want to add the "main" zone, i.e 2200 for 2205, etc
-                    zones.add(zoneId - zoneId % 100)
-
-            # This is set to an empty tuple because it's only defined if
-            # it's overwriting an interest, but needed anyway.
-            oldZones = ()
+            # We count the new zones first, so the zones both interests share stay visible.
+            newZones = self.addInterestZones(parentId, zones)
 
             if handle in self.interests:
-                # Our interest is overwriting another interest:
-                #
-                # - if the parent id is different, we're just gonna remove it by
-                #   disabling every object present in the old zones if we're not interested
-                #   in them anymore.
-                #
-                # - if it's the same parent id, we're gonna do some intersection stuff and
-                #   only send from the new zones and remove from the old zones,
-                #   basically not sending anything for the zones in the intersection
-
-                # We get the old interest
+                # Our interest is overwriting another interest, we only disable the
+                # objects in the old zones nothing else is interested in anymore.
                 oldParentId, oldZones = self.interests[handle]
 
-                # We remove it
-                del self.interests[handle]
-                self.updateInterestCache()
-
-                # We gotta disable the objects we can't see anymore,
-                if oldParentId == parentId:
-                    for do in self.stateServer.objects.values():
-                        # If the object is not visible anymore, we disable it
-                        # (it's in the removed interest zones, but not in the new interest (or any current interest) zones)
-                        if do.parentId == parentId and do.zoneId in oldZones and not (do.zoneId in zones or self.hasInterest(do.parentId, do.zoneId)):
-                            dg = Datagram()
-                            dg.addUint32(do.doId)
-                            self.sendMessage(CLIENT_OBJECT_DISABLE, dg)
-
-                    for do in self.stateServer.dbObjects.values():
-                        # If the object is not visible anymore, we disable it
-                        # (it's in the removed interest zones, but not in the new interest (or any current interest) zones)
-                        if do.parentId == parentId and do.zoneId in oldZones and not (do.zoneId in zones or self.hasInterest(do.parentId, do.zoneId)):
-                            dg = Datagram()
-                            dg.addUint32(do.doId)
-                            self.sendMessage(CLIENT_OBJECT_DISABLE, dg)
+                removedZones = self.removeInterestZones(oldParentId, oldZones)
+                for do in self.stateServer.getObjectsInZones(oldParentId, removedZones):
+                    dg = Datagram()
+                    dg.addUint32(do.doId)
+                    self.sendMessage(CLIENT_OBJECT_DISABLE, dg)
 
-                else:
-                    # We only check if we're no longer interested in
-                    for do in self.stateServer.objects.values():
-                        if do.parentId == oldParentId and do.zoneId in oldZones and not self.hasInterest(do.parentId, do.zoneId):
-                            dg = Datagram()
-                            dg.addUint32(do.doId)
-                            self.sendMessage(CLIENT_OBJECT_DISABLE, dg)
-
-                    # We only check if we're no longer interested in
-                    for do in self.stateServer.dbObjects.values():
-                        if do.parentId == oldParentId and do.zoneId in oldZones and not self.hasInterest(do.parentId, do.zoneId):
-                            dg = Datagram()
-                            dg.addUint32(do.doId)
-                            self.sendMessage(CLIENT_OBJECT_DISABLE, dg)
-
-                    # We set oldZones to an empty tuple
-                    # (because we're ignoring them as parentId is difference)
-                    oldZones = ()
+            # We save the interest
+            self.interests[handle] = (parentId, zones)
 
             # We send the newly visible objects
-            newZones = []
-            for zoneId in zones:
-                if not zoneId in oldZones and not self.hasInterest(parentId, zoneId):
-                    newZones.append(zoneId)
-
-            # We have got a new zone list, we can finally send the objects.
             self.sendObjects(parentId, newZones)
 
-            # We save the interest
-            self.interests[handle] = (parentId, zones)
-            self.updateInterestCache()
-
             # We tell the client we're done
             dg = Datagram()
             dg.addUint16(handle)
@@ -656,20 +612,13 @@ class Client:
 
             # We remove the interest
             del self.interests[handle]
-            self.updateInterestCache()
 
             # We disable all the objects we're no longer interested in
-            for do in self.stateServer.objects.values():
-                if do.parentId == oldParentId and do.zoneId in oldZones and not self.hasInterest(do.parentId, do.zoneId):
-                    dg = Datagram()
-                    dg.addUint32(do.doId)
-                    self.sendMessage(CLIENT_OBJECT_DISABLE, dg)
-
-            for do in self.stateServer.dbObjects.values():
-                if do.parentId == oldParentId and do.zoneId in oldZones and not self.hasInterest(do.parentId, do.zoneId):
-                    dg = Datagram()
-                    dg.addUint32(do.doId)
-                    self.sendMessage(CLIENT_OBJECT_DISABLE, dg)
+            removedZones = self.removeInterestZones(oldParentId, oldZones)
+            for do in self.stateServer.getObjectsInZones(oldParentId, removedZones):
+                dg = Datagram()
+                dg.addUint32(do.doId)
+                self.sendMessage(CLIENT_OBJECT_DISABLE, dg)
 
             # We tell the client we're done
             dg = Datagram()
@@ -901,19 +850,21 @@ class Client:
 
             friendsList = fields["setFriendsList"][0]
 
+            # We load all of our friends at once.
+            friendIds = [friend[0] for friend in friendsList]
+            friends = self.databaseServer.manager.loadDatabaseObjects(friendIds)
+
             count = 0
             friendData = {}
-            for i in range(0, len(friendsList)):
-                friendId = friendsList[i][0]
-
+            for friendId in friendIds:
                 # Make sure our friend actually has a database object!
                 # If it doesn't, Skip over it and emit a warning.
-                if not self.databaseServer.manager.hasDatabaseObject(friendId):
+                if not friendId in friends:
                     print("Friend %d for Avatar %d doesn't have a database object!" % (friendId, self.avatarId))
                     continue
 
                 # Load our fields from the friend in question.
-                friendsFields = self.databaseServer.manager.loadDatabaseObject(friendId).fields
+                friendsFields = friends[friendId].fields
 
                 # We're missing a required field, And this version of getting the list doesn't sanity check these
                 # individually.
@@ -1529,6 +1480,9 @@ class Client:
         # This is each blob of data for the avatars we have managed to load.
         avatarBlobs = []
 
+        # We load all of our avatars at once.
+        avatars = self.databaseServer.manager.loadDatabaseObjects([avId for avId in accountAvSet if avId])
+
         # We send every avatar
         for pos, avId in enumerate(accountAvSet):
             ndg = Datagram()
@@ -1537,14 +1491,13 @@ class Client:
             if avId == 0:
                 continue
 
-            if not self.databaseServer.manager.hasDatabaseObject(avId):
-                print("ERROR: Failed to load avatar %d for account %d, Avatar doesn't exist!" % (avId, self.account.doId))
-                accountAvSet[pos] = 0
-                continue
-
-            avatar = self.databaseServer.manager.loadDatabaseObject(avId)
+            avatar = avatars.get(avId)
             if not avatar:
-                print("ERROR: Failed to load avatar %d for account %d, An unknown error has occurred!" % (avId, self.account.doId))
+                if not self.databaseServer.manager.hasDatabaseObject(avId):
+                    print("ERROR: Failed to load avatar %d for account %d, Avatar doesn't exist!" % (avId, self.account.doId))
+                    accountAvSet[pos] = 0
+                else:
+                    print("ERROR: Failed to load avatar %d for account %d, An unknown error has occurred!" % (avId, self.account.doId))
                 continue
 
             ndg.addUint32(avatar.doId) # avNum
@@ -1582,11 +1535,7 @@ class Client:
         """
         Send a datagram
         """
-        try:
-            self.sock.send(struct.pack("<H", dg.getLength()))
-            self.sock.send(bytes(dg))
-        except:
-            print("Tried to send connection to client, But connection was closed!")
+        self.sendQueue.push(dg.getMessage())
             
     def handleFieldUpdate(self, doId, fieldName, value):
         # Can we send this field? If not just return.
@@ -1616,49 +1565,56 @@ class Client:
             # Send the message as if it was from the dos parent.
             self.messageDirector.sendMessage([do.doId], do.parentId, STATESERVER_OBJECT_UPDATE_FIELD, dg)
 
-    def hasInterest(self, parentId, zoneId):
+    def addInterestZones(self, parentId, zones):
         """
-        Check if we're interested in a zone
+        Count an interest in zones, and return the zones we weren't interested in before
         """
-        # Do we have this intereste cached?
-        return (parentId, zoneId) in self.__interestCache
+        newZones = []
+        for zoneId in zones:
+            location = (parentId, zoneId)
+            count = self.__interestCounts.get(location, 0)
+            self.__interestCounts[location] = count + 1
+
+            if not count:
+                # We let CA know we started watching this location
+                self.agent.addInterest(self, parentId, zoneId)
+                newZones.append(zoneId)
 
+        return newZones
 
-    def updateInterestCache(self):
-        self.__interestCache.clear()
+    def removeInterestZones(self, parentId, zones):
+        """
+        Uncount an interest in zones, and return the zones we're no longer interested in
+        """
+        removedZones = []
+        for zoneId in zones:
+            location = (parentId, zoneId)
+            count = self.__interestCounts.get(location, 0) - 1
 
-        for handle in self.interests:
-            parentId, zones = self.interests[handle]
+            if count > 0:
+                self.__interestCounts[location] = count
+                continue
 
-            for zoneId in zones:
-                self.__interestCache.add((parentId, zoneId))
+            # We let CA know we stopped watching this location
+            self.__interestCounts.pop(location, None)
+            self.agent.removeInterest(self, parentId, zoneId)
+            removedZones.append(zoneId)
 
-        return False
+        return removedZones
 
     def setClsendFields(self, doId, fields):
         self.__doId2ClsendOverrides[doId] = fields
 
     def sendObjects(self, parentId, zones):
+        # We get the objects in the new interest zones
         objects = []
-        for do in self.stateServer.objects.values():
-            # We're not sending our own object because
-            # we already know who we are (we are the owner)
-            if do.doId == self.avatarId:
-                continue
-
-            # If the object is in one of the new interest zones, we get it
-            if do.parentId == parentId and do.zoneId in zones:
-                objects.append(do)
-
-        for do in self.stateServer.dbObjects.values():
+        for do in self.stateServer.getObjectsInZones(parentId, zones):
             # We're not sending our own object because
             # we already know who we are (we are the owner)
             if do.doId == self.avatarId:
                 continue
 
-            # If the object is in one of the new interest zones, we get it
-            if do.parentId == parentId and do.zoneId in zones:
-                objects.append(do)
+            objects.append(do)
 
         # We sort them by dclass (fix some issues)
         objects.sort(key = lambda x: x.dclass.getNumber())
@@ -1716,6 +1672,7 @@ class Client:
 
         # We remember who we are
         self.avatarId = avatar.doId
+        self.agent.avatars[self.avatarId] = self
 
         # We can send that we are the proud owner of a DistributedToon!
         dg = Datagram()
@@ -1725,20 +1682,43 @@ class Client:
         self.sendMessage(CLIENT_GET_AVATAR_DETAILS_RESP, dg)
 
         # If we have friends... We should probably let them know we're online!
-        if "setFriendsList" in avatar.fields:
-            friendsList = avatar.fields["setFriendsList"][0]
+        self.notifyFriends(avatar, CLIENT_FRIEND_ONLINE)
+
+    def pinAccount(self):
+        """
+        Keep our account in the database cache while we're connected
+        """
+        if self.__pinnedAccountId == self.account.doId:
+            return
 
-            # Get all of our friend ids.
-            friendIds = []
-            for i in range(0, len(friendsList)):
-                friendIds.append(friendsList[i][0])
+        manager = self.databaseServer.manager
+        if self.__pinnedAccountId:
+            manager.unpinDatabaseObject(self.__pinnedAccountId)
 
-            for client in self.agent.clients:
-                # If the id matches, It means this friend is online!
-                if client.avatarId in friendIds:
-                    dg = Datagram()
-                    dg.addUint32(self.avatarId)
-                    client.sendMessage(CLIENT_FRIEND_ONLINE, dg)
+        # We make sure the cache has the same account as us.
+        manager.pinDatabaseObject(self.account.doId)
+        manager.cache.add(self.account)
+        self.__pinnedAccountId = self.account.doId
+
+    def notifyFriends(self, avatar, msgType):
+        """
+        Send msgType with our avatar id to every friend of avatar who is online
+        """
+        if not "setFriendsList" in avatar.fields:
+            return
+
+        # Get all of our friend ids.
+        friendIds = set()
+        for friend in avatar.fields["setFriendsList"][0]:
+            friendIds.add(friend[0])
+
+        for friendId in friendIds:
+            # If CA knows this avatar, It means this friend is online!
+            client = self.agent.avatars.get(friendId)
+            if client:
+                dg = Datagram()
+                dg.addUint32(self.avatarId)
+                client.sendMessage(msgType, dg)
 
     def removeAvatar(self):
         """
@@ -1752,23 +1732,11 @@ class Client:
         avatar = self.databaseServer.manager.loadDatabaseObject(self.avatarId)
 
         # If we have friends... We should probably let them know we're heading off.
-        if "setFriendsList" in avatar.fields:
-            friendsList = avatar.fields["setFriendsList"][0]
-
-            # Get all of our friend ids.
-            friendIds = []
-            for i in range(0, len(friendsList)):
-                friendIds.append(friendsList[i][0])
-
-            for client in self.agent.clients:
-                # If the id matches, It means this friend is now offline!
-                if client.avatarId in friendIds:
-                    dg = Datagram()
-                    dg.addUint32(self.avatarId)
-                    client.sendMessage(CLIENT_FRIEND_OFFLINE, dg)
+        self.notifyFriends(avatar, CLIENT_FRIEND_OFFLINE)
 
         # We ask State Server to delete our object
         dg = Datagram()
         dg.addUint32(self.avatarId)
         self.messageDirector.sendMessage([self.avatarId], self.avatarId, STATESERVER_OBJECT_DELETE_RAM, dg)
+        self.agent.avatars.pop(self.avatarId, None)
         self.avatarId = 0
@@ -1,8 +1,10 @@
 import os, socket, select, ssl, time
+from collections import OrderedDict
 
-from panda3d.core import ConfigVariableString, Datagram, DatagramIterator, DSearchPath, Filename, VirtualFileSystem
+from panda3d.core import ConfigVariableBool, ConfigVariableDouble, ConfigVariableInt, ConfigVariableString, Datagram, DatagramIterator, DSearchPath, Filename, VirtualFileSystem
 
 from dnaparser import loadDNAFile, DNAStorage
+from zone_util import getCanonicalZoneId, getTrueZoneId
 from msgtypes import *
 
 class ClientAgent:
@@ -26,13 +28,41 @@ class ClientAgent:
         self.sock = sock #context.wrap_socket(sock, server_side=True)
         self.clients = []
         
+        # Clients with an avatar, by avatar id
+        self.avatars = {}
+        
+        # Clients interested in a location, by (parentId, zoneId)
+        self.interested = {}
+        
         self.visgroups = {}
+        
+        # Zones seen from a zone, computed when they're first asked for.
+        # We only remember the most recent ones, Welcome Valley has a lot of zones.
+        self.zoneExpansions = OrderedDict()
+        self.zoneExpansionsSize = ConfigVariableInt("zone-expansion-cache-size", 4096).getValue()
             
         self.nameDictionary = {}
                 
         # Special fields IDs (cache)
         self.setTalkFieldId = self.dc.getClassByName("TalkPath_owner").getFieldByName("setTalk").getNumber()
         
+        # Smooth position updates can be held for a tick, and only the latest one
+        # of each object and field is sent to the clients.
+        self.wantSmoothCoalescing = ConfigVariableBool("want-smooth-coalescing", False).getValue()
+        self.smoothCoalescingTick = ConfigVariableDouble("smooth-coalescing-tick", 0.05).getValue()
+        
+        self.smoothFieldIds = set()
+        smoothNode = self.dc.getClassByName("DistributedSmoothNode")
+        if smoothNode:
+            for fieldName in ("setSmH", "setSmZ", "setSmXY", "setSmXZ", "setSmPos", "setSmHpr", "setSmXYZH", "setSmPosHpr", "setSmPosHprL"):
+                field = smoothNode.getFieldByName(fieldName)
+                if field:
+                    self.smoothFieldIds.add(field.getNumber())
+                    
+        # Held updates, doId -> (object, {fieldId: (field, data, sender)})
+        self.smoothUpdates = {}
+        self.smoothTimer = None
+        
         self.readFiles()
         
     def readFiles(self):
@@ -125,6 +155,58 @@ class ClientAgent:
                 nameId, nameCategory, name = line.split("*", 2)
                 self.nameDictionary[int(nameId)] = (int(nameCategory), name.strip())
             
+    def expandZone(self, zoneId):
+        """
+        Get the zone and every zone visible from it
+        """
+        zones = self.zoneExpansions.get(zoneId)
+        if zones is not None:
+            self.zoneExpansions.move_to_end(zoneId)
+            return zones
+            
+        zones = {zoneId}
+        
+        # We add visibles
+        canonicalZoneId = getCanonicalZoneId(zoneId)
+
+        if canonicalZoneId in self.visgroups:
+            for visZoneId in self.visgroups[canonicalZoneId]:
+                zones.add(getTrueZoneId(visZoneId, zoneId))
+
+            # We want to add the "main" zone, i.e 2200 for 2205, etc
+            zones.add(zoneId - zoneId % 100)
+            
+        zones = frozenset(zones)
+        
+        self.zoneExpansions[zoneId] = zones
+        if len(self.zoneExpansions) > self.zoneExpansionsSize:
+            self.zoneExpansions.popitem(last=False)
+            
+        return zones
+        
+    def addInterest(self, client, parentId, zoneId):
+        location = (parentId, zoneId)
+        if not location in self.interested:
+            self.interested[location] = set()
+            
+        self.interested[location].add(client)
+        
+    def removeInterest(self, client, parentId, zoneId):
+        location = (parentId, zoneId)
+        clients = self.interested.get(location)
+        if not clients:
+            return
+            
+        clients.discard(client)
+        if not clients:
+            del self.interested[location]
+            
+    def getInterestedClients(self, parentId, zoneId):
+        """
+        Get the clients interested in a location
+        """
+        return self.interested.get((parentId, zoneId), frozenset())
+            
     def announceCreate(self, do, sender):
         # We send to the interested clients that they have access to a brand new object!
         dg = Datagram()
@@ -135,34 +217,63 @@ class ClientAgent:
         do.packRequiredBroadcast(dg)
         do.packOther(dg)
         
-        for client in self.clients:
+        # We send the object creation if we're the owner or if we're interested.
+        clients = set(self.getInterestedClients(do.parentId, do.zoneId))
+        if do.doId in self.avatars:
+            clients.add(self.avatars[do.doId])
+        
+        for client in clients:
             # No echo pls
             if client.avatarId == sender:
                 continue
                 
-            # We send the object creation if we're the owner or if we're interested.
-            if client.hasInterest(do.parentId, do.zoneId) or do.doId == client.avatarId:
-                client.sendMessage(CLIENT_CREATE_OBJECT_REQUIRED_OTHER, dg)
+            client.sendMessage(CLIENT_CREATE_OBJECT_REQUIRED_OTHER, dg)
         
         
     def announceDelete(self, do, sender):
-        # We're deleting an object
-        dg = Datagram()
-        dg.addUint32(do.doId)
+        self.announceDeletes([do], sender)
         
-        for client in self.clients:
-            # Not retransmitting
-            if client.avatarId == sender:
-                continue
+    def announceDeletes(self, objects, sender):
+        """
+        Send CLIENT_OBJECT_DISABLE to interested clients for many objects,
+        looking the clients up once per zone
+        """
+        zones = {}
+        for do in objects:
+            # There's no need to send positions of an object we're disabling.
+            self.smoothUpdates.pop(do.doId, None)
+            
+            location = (do.parentId, do.zoneId)
+            if not location in zones:
+                zones[location] = []
+                
+            zones[location].append(do)
+            
+        owners = []
+        for location, zoneObjects in zones.items():
+            # We copy the clients, a disconnecting owner leaves the index
+            clients = list(self.getInterestedClients(*location))
+            
+            for do in zoneObjects:
+                # We're deleting an object
+                dg = Datagram()
+                dg.addUint32(do.doId)
+                
+                owner = self.avatars.get(do.doId)
+                if owner and owner.avatarId != sender:
+                    owners.append(owner)
                 
-            # If the client is the owner, we're in a special case and we're not sending the packet
-            if do.doId == client.avatarId:
-                client.onAvatarDelete()
+                # We tell the client that it's disabled only if they're interested.
+                for client in clients:
+                    # Not retransmitting
+                    if client.avatarId == sender or client is owner:
+                        continue
+                        
+                    client.sendMessage(CLIENT_OBJECT_DISABLE, dg)
             
-            # We tell the client that it's disabled only if they're interested or the owner.
-            # (Please note this last condition here is useless but it's meant to be replaced if owner view is implemented some day)
-            elif client.hasInterest(do.parentId, do.zoneId) or do.doId == client.avatarId:
-                client.sendMessage(CLIENT_OBJECT_DISABLE, dg)
+        # If the client is the owner, we're in a special case and we're not sending the packet
+        for owner in owners:
+            owner.onAvatarDelete()
         
         
     def announceMove(self, do, prevParentId, prevZoneId, sender):
@@ -170,6 +281,10 @@ class ClientAgent:
         Send CLIENT_OBJECT_LOCATION to interested clients,
         or CLIENT_OBJECT_DISABLE / CLIENT_CREATE_OBJECT_REQUIRED_OTHER
         """
+        # The held positions go to the clients which could see the object until now,
+        # the object is already in its new location.
+        self.flushObjectSmoothUpdates(do.doId, prevParentId, prevZoneId)
+        
         # Disable Message
         dg1 = Datagram()
         dg1.addUint32(do.doId)
@@ -189,7 +304,15 @@ class ClientAgent:
         do.packRequiredBroadcast(dg3)
         do.packOther(dg3)
         
-        for client in self.clients:
+        prevClients = self.getInterestedClients(prevParentId, prevZoneId)
+        newClients = self.getInterestedClients(do.parentId, do.zoneId)
+        
+        clients = set(prevClients)
+        clients.update(newClients)
+        if do.doId in self.avatars:
+            clients.add(self.avatars[do.doId])
+        
+        for client in clients:
             # We are not transmitting back our own updates
             if client.avatarId == sender:
                 continue
@@ -199,10 +322,10 @@ class ClientAgent:
                 client.sendMessage(CLIENT_OBJECT_LOCATION, dg2)
                 
             # If we're interested in the previous area
-            elif client.hasInterest(prevParentId, prevZoneId):
+            elif client in prevClients:
                 # If we're interested in the new area,
                 # we can just tell the client that the object moved
-                if client.hasInterest(do.parentId, do.zoneId):
+                if client in newClients:
                     client.sendMessage(CLIENT_OBJECT_LOCATION, dg2)
                 else:   
                     # If we're not, we ask them to disable the object
@@ -210,7 +333,7 @@ class ClientAgent:
                     
             # If we're only interested in the new area,
             # we ask them to create the object
-            elif client.hasInterest(do.parentId, do.zoneId):
+            else:
                 client.sendMessage(CLIENT_CREATE_OBJECT_REQUIRED_OTHER, dg3)
                 
                 
@@ -218,57 +341,156 @@ class ClientAgent:
         """
         Send CLIENT_OBJECT_UPDATE_FIELD to interested clients
         """
-        # This field has no reason to be transmitted if it's not ownrecv or broadcast
-        if not (field.isOwnrecv() or field.isBroadcast()):
+        self.announceUpdates(do, [(field, data)], sender)
+        
+    def announceUpdates(self, do, updates, sender):
+        """
+        Send CLIENT_OBJECT_UPDATE_FIELD to interested clients for many fields of an object,
+        holding the smooth position updates until the next tick if we're coalescing them
+        """
+        if not self.wantSmoothCoalescing:
+            self.sendUpdates(do, updates, sender)
             return
             
-        # We generate the field update
-        dg = Datagram()
-        dg.addUint32(do.doId)
-        dg.addUint16(field.getNumber())
-        dg.appendData(data)
-        
-        for client in self.clients:
-            # We are not transmitting back our own updates
-            if client.avatarId == sender:
+        immediate = []
+        for field, data in updates:
+            fieldId = field.getNumber()
+            if not fieldId in self.smoothFieldIds:
+                immediate.append((field, data))
                 continue
                 
-            # Can this client receive this update?
-            # TODO: is broadcast check required?
-            if (field.isOwnrecv() or not field.isBroadcast()) and client.avatarId != do.doId:
+            if not do.doId in self.smoothUpdates:
+                self.smoothUpdates[do.doId] = (do, {})
+                
+            # We only keep the latest one, sent in the order it came in.
+            fields = self.smoothUpdates[do.doId][1]
+            fields.pop(fieldId, None)
+            fields[fieldId] = (field, data, sender)
+            
+            if not self.smoothTimer:
+                self.smoothTimer = self.otp.reactor.addTimer(self.smoothCoalescingTick, self.flushSmoothUpdates)
+                
+        if immediate:
+            # The positions we're holding happened before, they must be sent first.
+            self.flushObjectSmoothUpdates(do.doId)
+            self.sendUpdates(do, immediate, sender)
+            
+    def flushObjectSmoothUpdates(self, doId, parentId=None, zoneId=None):
+        """
+        Send the held smooth position updates of an object,
+        to the clients interested in parentId and zoneId if given, or in the object location
+        """
+        if not doId in self.smoothUpdates:
+            return
+            
+        do, fields = self.smoothUpdates.pop(doId)
+        
+        # We group them by sender so we look the clients up once per sender.
+        senders = {}
+        for field, data, sender in fields.values():
+            if not sender in senders:
+                senders[sender] = []
+                
+            senders[sender].append((field, data))
+            
+        for sender, updates in senders.items():
+            self.sendUpdates(do, updates, sender, parentId, zoneId)
+            
+    def flushSmoothUpdates(self):
+        """
+        Send every held smooth position update
+        """
+        self.smoothTimer = None
+        
+        for doId in list(self.smoothUpdates):
+            self.flushObjectSmoothUpdates(doId)
+            
+    def sendUpdates(self, do, updates, sender, parentId=None, zoneId=None):
+        """
+        Send CLIENT_OBJECT_UPDATE_FIELD to interested clients for many fields of an object,
+        the clients are looked up once (in parentId and zoneId if given, or in the object location)
+        """
+        if parentId is None:
+            parentId, zoneId = do.parentId, do.zoneId
+            
+        interested = self.getInterestedClients(parentId, zoneId)
+        owner = self.avatars.get(do.doId)
+        
+        for field, data in updates:
+            # This field has no reason to be transmitted if it's not ownrecv or broadcast
+            if not (field.isOwnrecv() or field.isBroadcast()):
                 continue
                 
+            # We generate the field update
+            dg = Datagram()
+            dg.addUint32(do.doId)
+            dg.addUint16(field.getNumber())
+            dg.appendData(data)
+            
             # If we're interested OR owner, we send the update
-            if client.hasInterest(do.parentId, do.zoneId) or client.avatarId == do.doId:
+            # TODO: is broadcast check required?
+            if field.isOwnrecv() or not field.isBroadcast():
+                # Only the owner can receive this update
+                clients = set()
+            else:
+                clients = set(interested)
+                
+            if owner:
+                clients.add(owner)
+            
+            for client in clients:
+                # We are not transmitting back our own updates
+                if client.avatarId == sender:
+                    continue
+                    
                 client.sendMessage(CLIENT_OBJECT_UPDATE_FIELD, dg)
                 
         
+    def ownsChannel(self, channel):
+        """
+        Is this the puppet channel of one of our avatars?
+        """
+        return (channel - (1 << 32)) in self.avatars
+        
     def handle(self, channels, sender, code, datagram):
         """
         Handle a message
         """
         for channel in channels:
-            for client in self.clients:
-                if client.avatarId is None:
-                    continue
+            client = self.avatars.get(channel - (1 << 32))
+            if client:
+                if code == STATESERVER_OBJECT_UPDATE_FIELD:
+                    client.sendMessage(CLIENT_OBJECT_UPDATE_FIELD, datagram)
+                elif code == STATESERVER_OBJECT_UPDATE_FIELD_MULTIPLE:
+                    # The client only knows single field updates, we split them.
+                    dgi = DatagramIterator(datagram)
+                    doId = dgi.getUint32()
                     
-                if channel == client.avatarId + (1 << 32):
-                    if code == STATESERVER_OBJECT_UPDATE_FIELD:
-                        client.sendMessage(CLIENT_OBJECT_UPDATE_FIELD, datagram)
-                    elif code == CLIENT_SET_FIELD_SENDABLE:
-                        print("Recieved messsage type CLIENT_SET_FIELD_SENDABLE.")
-                        
-                        dgi = DatagramIterator(datagram)
-                        
-                        doId = dgi.getUint32()
-                        
-                        fields = []
-                        
-                        # We do it like this because we don't add a size check.
-                        while dgi.getRemainingSize() >= 2:
-                            fields.append(dgi.getUint16())
+                    do = self.otp.stateServer.getObject(doId)
+                    if not do:
+                        print("Received field updates for unknown object %d on Puppet channel." % (doId))
+                        continue
                         
-                        # Set the clsend fields for object in our client.
-                        client.setClsendFields(doId, fields)
-                    else:
-                        raise Exception("Unexpected message on Puppet channel (code %d)" % code)
\ No newline at end of file
+                    for field, data in do.schema.readFields(dgi, dgi.getUint16()):
+                        dg = Datagram()
+                        dg.addUint32(doId)
+                        dg.addUint16(field.getNumber())
+                        dg.appendData(data)
+                        client.sendMessage(CLIENT_OBJECT_UPDATE_FIELD, dg)
+                elif code == CLIENT_SET_FIELD_SENDABLE:
+                    print("Recieved messsage type CLIENT_SET_FIELD_SENDABLE.")
+                    
+                    dgi = DatagramIterator(datagram)
+                    
+                    doId = dgi.getUint32()
+                    
+                    fields = []
+                    
+                    # We do it like this because we don't add a size check.
+                    while dgi.getRemainingSize() >= 2:
+                        fields.append(dgi.getUint16())
+                    
+                    # Set the clsend fields for object in our client.
+                    client.setClsendFields(doId, fields)
+                else:
+                    raise Exception("Unexpected message on Puppet channel (code %d)" % code)
\ No newline at end of file
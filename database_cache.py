@@ -0,0 +1,188 @@
+import sys
+
+from collections import OrderedDict
+
+def estimateSize(value):
+    """
+    Roughly how many bytes a field value takes in memory
+    """
+    size = sys.getsizeof(value)
+
+    if isinstance(value, (tuple, list, set, frozenset)):
+        for item in value:
+            size += estimateSize(item)
+
+    elif isinstance(value, dict):
+        for key, item in value.items():
+            size += estimateSize(key) + estimateSize(item)
+
+    return size
+
+class DatabaseCache:
+    """
+    Least recently used DatabaseObjects, bounded by a number of objects and a number of bytes.
+    Pinned objects (live in the State Server, owned by a client...) are never evicted.
+    """
+    def __init__(self, maxObjects, maxBytes, isPinned=None):
+        self.maxObjects = maxObjects
+        self.maxBytes = maxBytes
+
+        # Called with a doId, returns if this object musn't be evicted.
+        self.isPinned = isPinned
+
+        # doId -> DatabaseObject we can evict, the least recently used first
+        self.objects = OrderedDict()
+
+        # doId -> DatabaseObject found pinned while evicting, set aside so we don't look at them every time.
+        # They go back with the others when they're used, unpinned, or when we check them again.
+        self.parked = {}
+
+        # How many more adds before we check the parked objects again
+        self.parkedCheckCountdown = 64
+
+        # doId -> estimated size in bytes
+        self.sizes = {}
+        self.totalBytes = 0
+
+        # Objects that changed since we estimated their size
+        self.staleSizes = set()
+
+        # Objects pinned explicitly, doId -> pin count
+        self.pins = {}
+
+        # Counters
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, doId):
+        return doId in self.objects or doId in self.parked
+
+    def __getitem__(self, doId):
+        if doId in self.parked:
+            return self.parked[doId]
+
+        return self.objects[doId]
+
+    def __len__(self):
+        return len(self.objects) + len(self.parked)
+
+    def get(self, doId):
+        """
+        Get a cached object and mark it as recently used, or None if it isn't cached
+        """
+        do = self.parked.pop(doId, None)
+        if do is not None:
+            self.objects[doId] = do
+
+        do = self.objects.get(doId)
+        if do is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.objects.move_to_end(doId)
+        return do
+
+    def add(self, do):
+        """
+        Cache an object, evicting the least recently used ones if we're full
+        """
+        self.remove(do.doId)
+
+        size = estimateSize(do.fields)
+        self.objects[do.doId] = do
+        self.sizes[do.doId] = size
+        self.totalBytes += size
+
+        self.evict()
+
+    def remove(self, doId):
+        do = self.objects.pop(doId, None)
+        if do is None:
+            do = self.parked.pop(doId, None)
+            if do is None:
+                return None
+
+        self.totalBytes -= self.sizes.pop(doId)
+        self.staleSizes.discard(doId)
+        return do
+
+    def changed(self, doId):
+        """
+        The fields of an object changed, its size will be estimated again
+        """
+        if doId in self.sizes:
+            self.staleSizes.add(doId)
+
+    def updateSizes(self):
+        for doId in self.staleSizes:
+            size = estimateSize(self[doId].fields)
+            self.totalBytes += size - self.sizes[doId]
+            self.sizes[doId] = size
+
+        self.staleSizes.clear()
+
+    def pin(self, doId):
+        self.pins[doId] = self.pins.get(doId, 0) + 1
+
+    def unpin(self, doId):
+        count = self.pins.get(doId, 0) - 1
+        if count > 0:
+            self.pins[doId] = count
+            return
+
+        self.pins.pop(doId, None)
+
+        # It can be evicted again, it's the least recently used one.
+        do = self.parked.pop(doId, None)
+        if do is not None:
+            self.objects[doId] = do
+            self.objects.move_to_end(doId, last=False)
+
+    def pinned(self, doId):
+        if doId in self.pins:
+            return True
+
+        return bool(self.isPinned and self.isPinned(doId))
+
+    def full(self):
+        return len(self) > self.maxObjects or self.totalBytes > self.maxBytes
+
+    def checkParked(self):
+        """
+        Give back the parked objects which aren't pinned anymore
+        """
+        for doId in list(self.parked):
+            if not self.pinned(doId):
+                self.objects[doId] = self.parked.pop(doId)
+                self.objects.move_to_end(doId, last=False)
+
+        # We check again after as many adds as there are parked objects, so it stays cheap.
+        self.parkedCheckCountdown = max(64, len(self.parked))
+
+    def evict(self):
+        self.updateSizes()
+
+        self.parkedCheckCountdown -= 1
+        if self.parkedCheckCountdown <= 0:
+            self.checkParked()
+
+        if not self.full():
+            return
+
+        # We go from the least recently used object, the pinned ones are parked,
+        # so each object is looked at once until it's used again.
+        while self.objects and self.full():
+            doId, do = self.objects.popitem(last=False)
+            if self.pinned(doId):
+                self.parked[doId] = do
+                continue
+
+            self.totalBytes -= self.sizes.pop(doId)
+            self.staleSizes.discard(doId)
+            self.evictions += 1
+
+    def getStats(self):
+        return {"objects": len(self), "bytes": self.totalBytes, "pinned": len(self.parked) + sum(1 for doId in self.objects if self.pinned(doId)),
+                "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
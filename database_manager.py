@@ -1,5 +1,8 @@
 import base64, hashlib, os, threading, traceback, uuid
 
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
 from datetime import datetime
 
 dbmType = "gnu"
@@ -22,10 +25,12 @@ from pprint import pformat
 # Use pymysql for our SQL connection.
 import pymysql as MySQLdb
 
-from panda3d.core import ConfigVariableInt, ConfigVariableString, Datagram, DatagramIterator, DSearchPath, Filename, VirtualFileSystem
+from panda3d.core import ConfigVariableBool, ConfigVariableDouble, ConfigVariableInt, ConfigVariableString, Datagram, DatagramIterator, DSearchPath, Filename, VirtualFileSystem
 from panda3d.direct import DCPacker
 
+from database_cache import DatabaseCache
 from database_object import DatabaseObject
+from database_writer import DatabaseWriter
 from distributed_object import DistributedObject
 from msgtypes import *
 
@@ -79,6 +84,30 @@ class DatabaseBackend:
         Loads the data from database to memory safely.
         """
     
+    def loadMany(self, doIds):
+        """
+        Safely loads many objects at once using a mutex lock,
+        so the process is thread safe...
+        """
+
+        with self._mutexLock:
+            return self.handleLoadMany(doIds)
+            
+    def handleLoadMany(self, doIds):
+        """
+        Loads many objects from database to memory, returns a dict of the ones that exist by doId.
+        """
+        objects = {}
+        for doId in doIds:
+            if not self.handleExists(doId):
+                continue
+                
+            do = self.handleLoad(doId)
+            if do:
+                objects[doId] = do
+                
+        return objects
+    
     def save(self, do):
         """
         Safely saves the data to database using a mutex lock,
@@ -94,12 +123,30 @@ class DatabaseBackend:
         """
         
     def exists(self, doId):
+        """
+        Safely checks if the doId exists in the database using a mutex lock,
+        so the process is thread safe...
+        """
+
+        with self._mutexLock:
+            return self.handleExists(doId)
+            
+    def handleExists(self, doId):
         """
         Return if the specified doId exists in the database.
         """
         return False
         
     def getNextDoId(self):
+        """
+        Safely gets the next open doId using a mutex lock,
+        so the process is thread safe...
+        """
+
+        with self._mutexLock:
+            return self.handleGetNextDoId()
+        
+    def handleGetNextDoId(self):
         """
         Get the next open doId for the backend we're using.
         """
@@ -124,6 +171,9 @@ class DatabaseBackendFile(DatabaseBackend):
         if not self.vfs.exists(self.databaseDirectory):
             self.vfs.makeDirectoryFull(self.databaseDirectory)
             
+        # Threads reading many files at once.
+        self.loadPool = ThreadPoolExecutor(max_workers=ConfigVariableInt('database-load-threads', 4).getValue())
+            
     def addToAccountServer(self, key, value):
         """
         Add a value to our database storage, If we don't have one.
@@ -164,13 +214,13 @@ class DatabaseBackendFile(DatabaseBackend):
         """
         return self.databaseStore != None
         
-    def exists(self, doId):
+    def handleExists(self, doId):
         """
         Return if the specified doId exists in the database.
         """
         return os.path.isfile(os.path.join(self.databaseDirectory.getFullpath(), str(doId) + self.databaseExtension))
         
-    def getNextDoId(self):
+    def handleGetNextDoId(self):
         """
         Get the next open doId for the backend we're using.
         """
@@ -183,6 +233,32 @@ class DatabaseBackendFile(DatabaseBackend):
             
         return max([int(filename[:-(len(self.databaseExtension))]) for filename in files if filename.endswith(self.databaseExtension)]) + 1
 
+    def handleLoadMany(self, doIds):
+        """
+        Loads many objects from database to memory, reading their files concurrently.
+        """
+        # We hold our lock for the whole batch, nothing gets written while we're reading.
+        objects = {}
+        for doId, do in zip(doIds, self.loadPool.map(self.tryLoad, doIds)):
+            if do:
+                objects[doId] = do
+                
+        return objects
+        
+    def tryLoad(self, doId):
+        """
+        Load an object if it exists, or return None
+        """
+        if not self.handleExists(doId):
+            return None
+            
+        try:
+            return self.handleLoad(doId)
+        except Exception:
+            traceback.print_exc()
+            
+        return None
+
 class DatabaseBackendRaw(DatabaseBackendFile):
     def __init__(self, manager):
         DatabaseBackendFile.__init__(self, manager)
@@ -362,6 +438,51 @@ class DatabaseBackendJSON(DatabaseBackendFile):
             # Close our file, Our data is now written.
             file.close()
         
+class MySQLConnectionPool:
+    """
+    Connections to our MySQL database, every thread using the database
+    (us, the database writer...) gets its own one and keeps it.
+    """
+    def __init__(self, connect):
+        self.connect = connect
+        self.local = threading.local()
+        
+        # Every connection we opened, so we can close them.
+        self.connections = []
+        self.lock = threading.Lock()
+        
+    def get(self):
+        db = getattr(self.local, "db", None)
+        if db is None or not db.open:
+            # We weren't connected yet, or we lost our connection.
+            db = self.connect()
+            self.local.db = db
+            
+            with self.lock:
+                self.connections = [connection for connection in self.connections if connection.open]
+                self.connections.append(db)
+                
+        return db
+        
+    def release(self):
+        """
+        Close the connection of this thread, the next use will reconnect
+        """
+        db = getattr(self.local, "db", None)
+        self.local.db = None
+        if db and db.open:
+            db.close()
+            
+    def closeAll(self):
+        with self.lock:
+            for db in self.connections:
+                if db.open:
+                    db.close()
+                    
+            self.connections = []
+            
+        self.local = threading.local()
+
 class DatabaseBackendMySQL(DatabaseBackend):
     # Types for reading our field datagrams.
     T_NONE = 0
@@ -383,7 +504,20 @@ class DatabaseBackendMySQL(DatabaseBackend):
         self.port = ConfigVariableInt("mysql-port", 3306).getValue()
         self.user = ConfigVariableString("mysql-user", "").getValue()
         self.passwd = ConfigVariableString("mysql-passwd", "").getValue()
-        self.db = None
+        self.pool = MySQLConnectionPool(self.newConnection)
+        
+        # Every thread has its own connection, we don't need to take turns.
+        self._mutexLock = nullcontext()
+        
+        # The tables we have, we check them once instead of before every query.
+        self.tables = set()
+        
+        # The columns of the fields table of each dclass, and the save statements we made for them.
+        self.fieldColumns = {}
+        self.saveStatements = {}
+        
+        # The doIds we know have a row in the objects table.
+        self.savedDoIds = set()
         
         # Get our language for any language specific database, Then get the name.
         language = ConfigVariableString("language", "english").getValue()
@@ -405,7 +539,7 @@ class DatabaseBackendMySQL(DatabaseBackend):
     def connect(self, host, port, user, passwd):
         # Try to connect to our MySQL database at the host.
         try:
-            self.db = MySQLdb.connect(host=host, port=port, user=user, passwd=passwd)
+            db = MySQLdb.connect(host=host, port=port, user=user, passwd=passwd)
         except MySQLdb.OperationalError as e:
             raise Exception("Failed to connect to MySQL db=%s at %s:%d."% (self.dbName, host, port))
             return
@@ -413,7 +547,7 @@ class DatabaseBackendMySQL(DatabaseBackend):
         print("Connected to gamedb=%s at %s:%d." % (self.dbName, host, port))
         
         # Temp hack for developers, Create DB structure if it doesn't exist already.
-        cursor = self.db.cursor()
+        cursor = db.cursor()
         try:
             cursor.execute("CREATE DATABASE `%s`" % self.dbName)
             if __debug__:
@@ -425,51 +559,74 @@ class DatabaseBackendMySQL(DatabaseBackend):
             # print('%s' % str(e))
             pass
             
-        # We don't want our data to auto-commit, We want to rollback any errors.
-        self.db.autocommit(False)
-            
-        cursor.execute("USE `%s`" % self.dbName)
+        # Our pool connections use the database directly.
+        db.close()
         if __debug__:
             print("Using database '%s'" % self.dbName)
             
         # We've connected to our database! Now we want to create our tables if we need to.
         # Let's check for them all.
         self.checkTables()
+        
+    def newConnection(self):
+        # We don't want our data to auto-commit, We want to rollback any errors.
+        # Our reads must see what the other connections (the database writer) committed,
+        # not the snapshot of the first read of our transaction.
+        return MySQLdb.connect(host=self.host, port=self.port, user=self.user, passwd=self.passwd, db=self.dbName, autocommit=False,
+                               init_command="SET SESSION TRANSACTION ISOLATION LEVEL READ COMMITTED")
+        
+    def endRead(self):
+        """
+        End the transaction our reads started, so it doesn't stay open
+        """
+        try: self.db.rollback()
+        except: pass
+        
+    @property
+    def db(self):
+        """
+        The connection of the current thread
+        """
+        return self.pool.get()
             
     def reconnect(self):
-        if not self.db:
-            # For some reason, We weren't connected to begin with! Try to connect to the server!
-            #print("MySQL server was missing, attempting to reconnect.")
-            #self.db.close()
-            self.db = MySQLdb.connect(host=self.host, port=self.port, user=self.user, passwd=self.passwd)
-            # We don't want our data to auto-commit, We want to rollback any errors.
-            self.db.autocommit(False)
-        else:
-            # Ping the server, And attempt to reconnect to the host.
-            self.db.ping(True)
-
-        cursor = self.db.cursor()
-        cursor.execute("USE `%s`" % self.dbName)
+        # We drop our connection, the next query will open a new one.
+        self.pool.release()
         print("Reconnected to MySQL server at %s:%d." % (self.host, self.port))
 
     def disconnect(self):
-        if self.db:
-            self.db.close()
-            self.db = None
+        self.pool.closeAll()
+        
+    def loadTables(self):
+        """
+        Remember which tables we have, and which columns the fields tables have
+        """
+        cursor = self.db.cursor()
+        cursor.execute("SHOW TABLES;")
+        # MySQL can lower the case of table names (e.g. on Windows).
+        self.tables = set(row[0].lower() for row in cursor.fetchall())
+        
+        self.fieldColumns = {}
+        for i in range(0, self.dc.getNumClasses()):
+            dcc = self.dc.getClass(i)
+            if not "%s_fields" % (dcc.getName().lower()) in self.tables:
+                continue
+                
+            columns = []
+            for j in range(0, dcc.getNumInheritedFields()):
+                field = dcc.getInheritedField(j)
+                if field.isDb() and not field.asMolecularField():
+                    columns.append(field.getName())
+                    
+            self.fieldColumns[dcc.getName()] = frozenset(columns)
+            
+        self.saveStatements = {}
             
     def checkTables(self):
-        if not self.db:
-            print("Could not check the SQL tables because we don't have a MYSQL server connection! Attempting to reconnect.")
-            # Reconnect if we can.
-            self.reconnect()
-            # Retry our check.
-            self.checkTables()
-            return
-
-        cursor = self.db.cursor()
-        dictCursor = MySQLdb.cursors.DictCursor(self.db)
+        db = self.db
+        cursor = db.cursor()
         try:
-            self.db.begin() # Start transaction
+            db.begin() # Start transaction
             
             # Check our "database server" accounts table. 
             cursor.execute("Show tables like 'accounts';")
@@ -541,18 +698,20 @@ class DatabaseBackendMySQL(DatabaseBackend):
                 if numFields > 0: cursor.execute(ss)
                     
                 
-            self.db.commit() # End transaction
+            db.commit() # End transaction
         except MySQLdb.OperationalError as e:
-            self.notify.warning("Unknown error when creating tables, retrying:\n%s" % str(e))
-            self.db.rollback() # Revert transaction
+            print("Unknown error when creating tables:\n%s" % str(e))
+            db.rollback() # Revert transaction
         except Exception as e:
             # Attempt to revert transaction.
-            try: self.db.rollback()
+            try: db.rollback()
             except: pass
             
             # Output our error.
             traceback.print_exc()
             
+        self.loadTables()
+            
     def addToAccountServer(self, key, value):
         """
         Add a value to our database storage, If we don't have one.
@@ -563,27 +722,26 @@ class DatabaseBackendMySQL(DatabaseBackend):
             
         cursor = self.db.cursor()
         try:
-            self.db.begin() # Start transaction
-            
             # Check our "database server" accounts table. 
-            cursor.execute("Show tables like 'accounts';")
-            if not cursor.rowcount:
-                self.db.rollback() # Revert transaction
+            if not "accounts" in self.tables:
                 raise Exception("Tried to add value to account server, But the table for our accounts doesn't exist!")
                 return
-                
+            
+            # This ends its own read, so we do it before our transaction.
             if self.getFromAccountServer(key) == value:
                 raise Exception("Tried to add value to account server, But the table for this account already exists!")
                 return
 
-            cursor.execute("INSERT INTO accounts (accountName, doId) VALUES (%s, %s)", (key, value))
+            self.db.begin() # Start transaction
             
+            cursor.execute("INSERT INTO accounts (accountName, doId) VALUES (%s, %s)", (key, value))
+        
             self.db.commit() # End transaction
         except MySQLdb.OperationalError as e:
             self.db.rollback() # Revert transaction
         except Exception as e:
             self.db.rollback() # Revert transaction
-            
+        
             # Output our error.
             traceback.print_exc()
         
@@ -598,12 +756,11 @@ class DatabaseBackendMySQL(DatabaseBackend):
         cursor = MySQLdb.cursors.DictCursor(self.db)
         try:
             # Check our "database server" accounts table. 
-            cursor.execute("Show tables like 'accounts';")
-            if not cursor.rowcount: return None
-            
+            if not "accounts" in self.tables: return None
+        
             cursor.execute("SELECT doId FROM accounts where accountName=%s", (key,))
             res = cursor.fetchone()
-            
+        
             if not res: return None
             return res["doId"]
         except MySQLdb.OperationalError as e:
@@ -611,6 +768,9 @@ class DatabaseBackendMySQL(DatabaseBackend):
         except Exception as e:
             # Output our error.
             traceback.print_exc()
+        finally:
+            # We're done reading.
+            self.endRead()
     
     def inAccountServer(self, key):
         """
@@ -626,21 +786,8 @@ class DatabaseBackendMySQL(DatabaseBackend):
         """
         Check if we have a file or server for account database storage.
         """
-        
-        if not self.db: return False
-
-        cursor = self.db.cursor()
-        try:
-            # Check our "database server" accounts table. 
-            cursor.execute("Show tables like 'accounts';")
-            if cursor.rowcount: return True
-        except MySQLdb.OperationalError as e:
-            pass
-        except Exception as e:
-            # Output our error.
-            traceback.print_exc()
-            
-        return False
+        # Check our "database server" accounts table. 
+        return "accounts" in self.tables
         
     def __unpackValue(self, value=None, field=None, dgi=None):
         if isinstance(value, str): # Make sure we're working with a bytes object.
@@ -696,20 +843,15 @@ class DatabaseBackendMySQL(DatabaseBackend):
 
         cursor = MySQLdb.cursors.DictCursor(self.db)
         try:
-            if not self.exists(doId):
-                return None # If the doId doesn't exist. Just return nothing.
-                
             # Check our databases dc object table. 
-            cursor.execute("Show tables like 'objects';")
-            if not cursor.rowcount:
+            if not "objects" in self.tables:
                 print("Can't load a database object because the object table is missing!")
                 return None # If the table doesn't exist. Just return the default.
             
             cursor.execute("SELECT * FROM objects where doId=%s", (doId,))
             objData = cursor.fetchone()
             if not objData: 
-                print("Can't load a database object because the object does not exist!")
-                return None # If we got no result, There is no objects.
+                return None # If we got no result, The doId doesn't exist.
             
             dcClassName = objData["dcClass"]
             dcClass = self.dc.getClassByName(dcClassName)
@@ -717,9 +859,6 @@ class DatabaseBackendMySQL(DatabaseBackend):
                 print("Can't load a database object because the objects dcclass does not exist!")
                 return None # If we got no result, There is no valid class.
 
-            # Create our Database Object.
-            do = DatabaseObject(self.manager, objData["doId"], uuid.UUID(objData["uuId"]), dcClass)
-            
             ss = "SELECT * FROM %s_fields where doId=%%s" % (dcClassName)
             cursor.execute(ss, (doId,))
             res = cursor.fetchone()
@@ -727,31 +866,103 @@ class DatabaseBackendMySQL(DatabaseBackend):
                 print("Can't load a database object because the object does not have fields!")
                 return None # If we got no result, There is no valid fields.
             
-            del res["doId"] # This isn't needed or used here.
+            self.savedDoIds.add(doId)
+            return self.__makeObject(objData, dcClass, res)
+        except MySQLdb.OperationalError as e:
+            pass
+        except Exception as e:
+            # Output our error.
+            traceback.print_exc()
+        finally:
+            # We're done reading.
+            self.endRead()
+            
+        return None
+        
+    def __makeObject(self, objData, dcClass, res):
+        """
+        Create a Database Object from its objects row and its fields row.
+        """
+        # Create our Database Object.
+        do = DatabaseObject(self.manager, objData["doId"], uuid.UUID(objData["uuId"]), dcClass)
+        
+        del res["doId"] # This isn't needed or used here.
+        
+        fields = {}
+        
+        # Go through all the results and unpack them.
+        for fieldName, value in res.items():
+            field = dcClass.getFieldByName(fieldName)
+            if not field: continue
+            
+            # Unpack our field.
+            value = self.__unpackValue(value=value, field=field)
             
-            fields = {}
+            fields[fieldName] = value 
+            
+        # Set our fields!
+        do.setFields(fields)
+        
+        return do
+        
+    def handleLoadMany(self, doIds):
+        """
+        Loads many objects from database to memory, with one query per dclass table.
+        """
+        objects = {}
+        if not doIds:
+            return objects
             
-            # Go through all the results and unpack them.
-            for fieldName, value in res.items():
-                field = dcClass.getFieldByName(fieldName)
-                if not field: continue
+        cursor = MySQLdb.cursors.DictCursor(self.db)
+        try:
+            # Check our databases dc object table. 
+            if not "objects" in self.tables:
+                print("Can't load database objects because the object table is missing!")
+                return objects
                 
-                # Unpack our field.
-                value = self.__unpackValue(value=value, field=field)
+            ss = "SELECT * FROM objects where doId IN (%s)" % (", ".join(["%s"] * len(doIds)))
+            cursor.execute(ss, tuple(doIds))
+            
+            # We group the objects by dclass, each one has its own fields table.
+            classObjects = {}
+            for objData in cursor.fetchall():
+                dcClassName = objData["dcClass"]
+                if not dcClassName in classObjects:
+                    classObjects[dcClassName] = []
+                    
+                classObjects[dcClassName].append(objData)
                 
-                fields[fieldName] = value 
+            for dcClassName, objDatas in classObjects.items():
+                dcClass = self.dc.getClassByName(dcClassName)
+                if not dcClass:
+                    print("Can't load database objects because their dcclass %s does not exist!" % (dcClassName))
+                    continue
+                    
+                ss = "SELECT * FROM %s_fields where doId IN (%s)" % (dcClassName, ", ".join(["%s"] * len(objDatas)))
+                cursor.execute(ss, tuple(objData["doId"] for objData in objDatas))
                 
-            # Set our fields!
-            do.setFields(fields)
-            
-            return do
+                fieldRows = {}
+                for res in cursor.fetchall():
+                    fieldRows[res["doId"]] = res
+                    
+                for objData in objDatas:
+                    res = fieldRows.get(objData["doId"])
+                    if not res:
+                        print("Can't load database object %d because the object does not have fields!" % (objData["doId"]))
+                        continue
+                        
+                    self.savedDoIds.add(objData["doId"])
+                    objects[objData["doId"]] = self.__makeObject(objData, dcClass, res)
         except MySQLdb.OperationalError as e:
             pass
         except Exception as e:
             # Output our error.
             traceback.print_exc()
+        finally:
+            # We're done reading.
+            self.endRead()
             
-        return None
+        return objects
         
     def __packValue(self, value, field, root=True):
         dg = Datagram()
@@ -818,113 +1029,115 @@ class DatabaseBackendMySQL(DatabaseBackend):
         value = dgi.getRemainingBytes() # .decode("latin-1")
         return value
         
+    def getSaveStatement(self, dcName, columns):
+        """
+        Get the statement inserting or updating the fields row of an object, made once per dclass and columns
+        """
+        key = (dcName, columns)
+        if not key in self.saveStatements:
+            if columns:
+                self.saveStatements[key] = "INSERT INTO %s_fields (doId, %s) VALUES (%s) ON DUPLICATE KEY UPDATE %s;" % (
+                    dcName, ", ".join(columns), ", ".join(["%s"] * (len(columns) + 1)),
+                    ", ".join(["%s=VALUES(%s)" % (column, column) for column in columns]))
+            else:
+                self.saveStatements[key] = "INSERT IGNORE INTO %s_fields (doId) VALUES (%%s);" % (dcName)
+                
+        return self.saveStatements[key]
+        
     def handleSave(self, do):
         """
         Dumps the data from memory out to database safely.
         """
-        
+        dcName = do.dclass.getName()
 
         cursor = self.db.cursor()
         try:
             self.db.begin() # Start transaction
             
             # Check our "database server" accounts table. 
-            cursor.execute("Show tables like 'objects';")
-            if not cursor.rowcount:
+            if not "objects" in self.tables:
                 self.db.rollback() # Revert transaction
                 raise Exception("Tried to add database object to database, But the table for our objects doesn't exist!")
                 return
             
-            if not self.exists(do.doId):
-                # Create the dc object handler for our newly saved database object.
-                cursor.execute("INSERT INTO objects (dcClass, doId, uuId) VALUES (%s, %s, %s);", (do.dclass.getName(), do.doId, str(do.uuId)))
-                
-                # Create the fields table for our newly handled dc object and fill them.
-                ss = "INSERT INTO %s_fields (doId) VALUES (%%s);" % (do.dclass.getName())
-                cursor.execute(ss, (do.doId,))
+            if not do.doId in self.savedDoIds:
+                # Create the dc object handler for our newly saved database object, if it's new.
+                cursor.execute("INSERT IGNORE INTO objects (dcClass, doId, uuId) VALUES (%s, %s, %s);", (dcName, do.doId, str(do.uuId)))
                 
-                # Go over all our fields and save them all into our fields.
-                for fieldName, value in do.getFields().items():
-                    field = do.dclass.getFieldByName(fieldName)
-                    if not field or not field.isDb():
-                        continue
-                    value = self.__packValue(value, field)
-                    # Some types of value need different packing then others.
-                    if isinstance(value, str):
-                        fs = "UPDATE %s_fields SET %s='%s' WHERE doId=%s;" % (do.dclass.getName(), fieldName, MySQLdb.converters.escape_string(value), str(do.doId))
-                        cursor.execute(fs)
-                    else:
-                        fs = "UPDATE %s_fields SET %s=%%s WHERE doId=%s;" % (do.dclass.getName(), fieldName, str(do.doId))
-                        cursor.execute(fs, (value,))
-            else:
-                # Just update and save our fields!
-                for fieldName, value in do.getFields().items():
-                    field = do.dclass.getFieldByName(fieldName)
-                    if not field or not field.isDb():
-                        continue
-                    value = self.__packValue(value, field)
-                    # Some types of value need different packing then others.
-                    if isinstance(value, str):
-                        fs = "UPDATE %s_fields SET %s='%s' WHERE doId=%s;" % (do.dclass.getName(), fieldName, value, str(do.doId))
-                        cursor.execute(fs)
-                    else:
-                        fs = "UPDATE %s_fields SET %s=%%s WHERE doId=%s;" % (do.dclass.getName(), fieldName, str(do.doId))
-                        cursor.execute(fs, (value,))
+            # We save all our fields at once, in the fields table of our dclass.
+            tableColumns = self.fieldColumns.get(dcName)
+            if tableColumns is not None:
+                fields = do.getFields()
+                columns = tuple(sorted(fieldName for fieldName in fields if fieldName in tableColumns))
                 
+                values = [do.doId]
+                for fieldName in columns:
+                    values.append(self.__packValue(fields[fieldName], do.dclass.getFieldByName(fieldName)))
+                    
+                cursor.execute(self.getSaveStatement(dcName, columns), values)
             
             self.db.commit() # End transaction
-        except MySQLdb.OperationalError as e:
-            self.db.rollback() # Revert transaction
+            self.savedDoIds.add(do.doId)
         except Exception as e:
-            self.db.rollback() # Revert transaction
+            # Attempt to revert transaction.
+            try: self.db.rollback()
+            except: pass
             
-            # Output our error.
-            traceback.print_exc()
+            # Our caller must know it wasn't saved (the database writer tries again).
+            raise
         
-    def exists(self, doId):
+    def handleExists(self, doId):
         """
         Return if the specified doId exists in the database.
         """
 
         cursor = MySQLdb.cursors.DictCursor(self.db)
         try:
+            if doId in self.savedDoIds: return True
+            
             # Check our databases dc object table. 
-            cursor.execute("Show tables like 'objects';")
-            if not cursor.rowcount: return False
+            if not "objects" in self.tables: return False
             
             cursor.execute("SELECT uuId FROM objects where doId=%s", (doId,))
             res = cursor.fetchone()
             
-            if not res: return False
-            return res.get("uuId", None) != None
+            if not res or res.get("uuId", None) == None: return False
+            
+            self.savedDoIds.add(doId)
+            return True
         except MySQLdb.OperationalError as e:
             pass
         except Exception as e:
             # Output our error.
             traceback.print_exc()
+        finally:
+            # We're done reading.
+            self.endRead()
             
         return False
         
-    def getNextDoId(self):
+    def handleGetNextDoId(self):
         """
         Get the next open doId for the backend we're using.
         """
         cursor = MySQLdb.cursors.DictCursor(self.db)
         try:
             # Check our databases dc object table. 
-            cursor.execute("Show tables like 'objects';")
-            if not cursor.rowcount: return 10000000 # If the table doesn't exist. Just return the default.
+            if not "objects" in self.tables: return 10000000 # If the table doesn't exist. Just return the default.
             
-            cursor.execute("SELECT * FROM objects")
-            res = cursor.fetchall()
+            cursor.execute("SELECT COUNT(*) AS count FROM objects")
+            res = cursor.fetchone()
             
             if not res: return 10000000 # If we got no result, There is no objects.
-            return 10000000 + len(res) # Add the number of objects to the base id.
+            return 10000000 + res["count"] # Add the number of objects to the base id.
         except MySQLdb.OperationalError as e:
             pass
         except Exception as e:
             # Output our error.
             traceback.print_exc()
+        finally:
+            # We're done reading.
+            self.endRead()
             
         return 10000000
 
@@ -936,8 +1149,16 @@ class DatabaseManager:
         # DC File
         self.dc = self.dbss.dc
         
-        # Cached DBObjects
-        self.cache = {}
+        # Cached DBObjects, the least recently used ones are evicted when we're full
+        self.cache = DatabaseCache(ConfigVariableInt('database-cache-size', 4096).getValue(),
+                                   ConfigVariableInt('database-cache-bytes', 64 << 20).getValue(),
+                                   self.isPinned)
+        
+        # The doIds we know exist, and the ones we know don't,
+        # so we don't have to ask the backend every time.
+        self.existingDoIds = set()
+        self.missingDoIds = set()
+        self.maxMissingDoIds = ConfigVariableInt('database-missing-cache-size', 65536).getValue()
         
         # DBS Objects
         self.dcObjectTypes = self.dbss.dcObjectTypes
@@ -959,6 +1180,14 @@ class DatabaseManager:
             self.backend = DatabaseBackendMySQL(self)
         else: # Default to raw.
             self.backend = DatabaseBackendRaw(self)
+            
+        # Changed objects are saved by a background thread, unless we don't want to.
+        self.writer = None
+        if ConfigVariableBool('want-database-write-behind', True).getValue():
+            self.writer = DatabaseWriter(self.backend, self.dbss.otp.reactor,
+                                         ConfigVariableDouble('database-flush-interval', 5.0).getValue(),
+                                         ConfigVariableInt('database-flush-threshold', 256).getValue())
+            self.writer.start()
         
     def createDatabaseObject(self, dcObjectType, fields={}):
         """
@@ -1018,8 +1247,10 @@ class DatabaseManager:
         if dclass.getName() in list(self.dcObjectTypeFromName.keys()):
             do.fields["DcObjectType"] = dclass.getName()
 
-        # We save the object
-        self.saveDatabaseObject(do)
+        # We save the object now, the backend needs to know about it before anyone asks.
+        self.backend.save(do)
+        self.existingDoIds.add(doId)
+        self.missingDoIds.discard(doId)
         return do
         
     def createDatabaseObjectFromName(self, dclassName, fields={}):
@@ -1040,19 +1271,134 @@ class DatabaseManager:
         """
         Check if a database object exists.
         """
-        return self.backend.exists(doId)
+        if doId in self.existingDoIds or doId in self.cache:
+            return True
+            
+        if doId in self.missingDoIds:
+            return False
+            
+        if self.backend.exists(doId):
+            self.existingDoIds.add(doId)
+            return True
+            
+        self.addMissingDoId(doId)
+        return False
+        
+    def addMissingDoId(self, doId):
+        # We don't want to remember every bad doId we were asked about forever.
+        if len(self.missingDoIds) >= self.maxMissingDoIds:
+            self.missingDoIds.clear()
+            
+        self.missingDoIds.add(doId)
         
     def saveDatabaseObject(self, do):
         """
-        Save a database object
+        Save a database object, with the next flush if we're writing behind
         """
-        self.backend.save(do)
+        # Its size in the cache changed.
+        self.cache.changed(do.doId)
+        
+        if self.writer:
+            self.writer.markDirty(do)
+            return
+            
+        try:
+            self.backend.save(do)
+        except Exception:
+            # Output our error.
+            traceback.print_exc()
+            
+    def flushDatabaseObjects(self, doIds=None):
+        """
+        Save the changed database objects right now, or only the ones in doIds
+        """
+        if self.writer:
+            self.writer.flush(doIds)
+            
+    def shutdown(self):
+        """
+        Save everything that changed and stop the background saving
+        """
+        if self.writer:
+            self.writer.stop()
+            self.writer = None
 
     def loadDatabaseObject(self, doId):
         """
         Load a database object by its id
         """
-        if not doId in self.cache:
-            self.cache[doId] = self.backend.load(doId)
+        do = self.cache.get(doId)
+        if do is None and self.writer:
+            # It left the cache before it was saved, the backend has an older version.
+            do = self.writer.get(doId)
+            
+        if do is None:
+            do = self.backend.load(doId)
+
+        # We don't remember the objects we couldn't load.
+        if do is not None and not doId in self.cache:
+            self.cache.add(do)
+            self.existingDoIds.add(doId)
+
+        return do
+
+    def loadDatabaseObjects(self, doIds):
+        """
+        Load many database objects at once, returns a dict of the ones that exist by doId
+        """
+        objects = {}
+        toLoad = []
+        for doId in doIds:
+            if doId in objects or doId in self.missingDoIds:
+                continue
+                
+            do = self.cache.get(doId)
+            if do is None and self.writer:
+                # It left the cache before it was saved, the backend has an older version.
+                do = self.writer.get(doId)
+                
+            if do is None:
+                toLoad.append(doId)
+            else:
+                objects[doId] = do
+                
+        # Everything we don't have is fetched from the backend in one go.
+        if toLoad:
+            loaded = self.backend.loadMany(list(set(toLoad)))
+            objects.update(loaded)
+            
+            # We remember the ones the backend doesn't have, like hasDatabaseObject does.
+            for doId in toLoad:
+                if not doId in loaded and not doId in self.existingDoIds:
+                    self.addMissingDoId(doId)
+                
+        for doId, do in objects.items():
+            if not doId in self.cache:
+                self.cache.add(do)
+                self.existingDoIds.add(doId)
+                
+        return objects
+        
+    def isPinned(self, doId):
+        """
+        Check if a database object musn't be evicted from the cache
+        """
+        # It's live in the State Server, it's getting updates.
+        stateServer = self.dbss.stateServer
+        if doId in stateServer.objects or doId in stateServer.dbObjects:
+            return True
+
+        # It's the avatar of a connected client.
+        return doId in self.dbss.clientAgent.avatars
+
+    def pinDatabaseObject(self, doId):
+        """
+        Keep a database object in the cache until it's unpinned
+        """
+        self.cache.pin(doId)
+
+    def unpinDatabaseObject(self, doId):
+        self.cache.unpin(doId)
 
-        return self.cache[doId]
\ No newline at end of file
+    def getCacheStats(self):
+        return self.cache.getStats()
@@ -1,5 +1,5 @@
-import uuid
-from panda3d.direct import DCPacker
+import copy, uuid
+from packer_pool import packerPool
 from pprint import pformat
 
 class DatabaseObject:
@@ -15,6 +15,8 @@ class DatabaseObject:
     version = (majVer, minVer, subVer)
     minVersion = (supMajVer, supMinVer, supSubVer)
     
+    __slots__ = ("dbm", "doId", "uuId", "dclass", "fields", "dcObjectType")
+    
     def __init__(self, dbm, doId, uuId, dclass):
         self.dbm = dbm
         self.doId = doId
@@ -23,8 +25,17 @@ class DatabaseObject:
         self.fields = {}
         self.dcObjectType = 0
         
+    def snapshot(self):
+        """
+        Get a copy of this object that can be saved while this one keeps changing
+        """
+        do = DatabaseObject(self.dbm, self.doId, self.uuId, self.dclass)
+        do.fields = copy.deepcopy(self.fields)
+        do.dcObjectType = self.dcObjectType
+        return do
+
     def packRequired(self, dg):
-        packer = DCPacker()
+        packer = packerPool.get()
         for index in range(self.dclass.getNumInheritedFields()):
             field = self.dclass.getInheritedField(index)
             if field.isRequired():
@@ -37,10 +48,11 @@ class DatabaseObject:
                 packer.endPack()
                 
         dg.appendData(packer.getBytes())
+        packerPool.release(packer)
         
         
     def packOther(self, dg):
-        packer = DCPacker()
+        packer = packerPool.get()
         count = 0
         
         for index in range(self.dclass.getNumInheritedFields()):
@@ -59,34 +71,36 @@ class DatabaseObject:
                 
         dg.addUint16(count)
         dg.appendData(packer.getBytes())
+        packerPool.release(packer)
     
     def packField(self, fieldName, value):
         field = self.dclass.getFieldByName(fieldName)
         if not field:
             return None
         
-        packer = DCPacker()
+        packer = packerPool.get()
         packer.beginPack(field)
         field.packArgs(packer, value)
         packer.endPack()
+        data = packer.getBytes()
+        packerPool.release(packer)
         
-        return packer.getBytes()
+        return data
         
     def unpackField(self, fieldName, data):
-        packer = DCPacker()
-
         if not data:
             return None
             
-        packer.setUnpackData(data)
-        
         field = self.dclass.getFieldByName(fieldName)
         if not field:
             return None
             
+        packer = packerPool.get()
+        packer.setUnpackData(data)
         packer.beginUnpack(field)
         value = field.unpackArgs(packer)
         packer.endUnpack()
+        packerPool.release(packer)
 
         return value
         
@@ -117,35 +131,52 @@ class DatabaseObject:
     def getFields(self):
         return self.fields
         
-    def receiveField(self, field, di):
-        packer = DCPacker()
-        packer.setUnpackData(di.getRemainingBytes())
-        
+    def unpackUpdate(self, packer, field):
         molecular = field.asMolecularField()
         if molecular:
-            for n in range(molecular.getNumAtomics()):
-                atomic = molecular.getAtomic(n)
-                
-                packer.beginUnpack(atomic)
-                value = atomic.unpackArgs(packer)
-                
-                if atomic.isDb():
-                    self.fields[atomic.getName()] = value
-                    
-                packer.endUnpack()
-                
+            atomics = [molecular.getAtomic(n) for n in range(molecular.getNumAtomics())]
         else:
-            packer.beginUnpack(field)
-            value = field.unpackArgs(packer)
+            atomics = (field,)
             
-            if field.isDb():
-                self.fields[field.getName()] = value
+        for atomic in atomics:
+            packer.beginUnpack(atomic)
+            value = atomic.unpackArgs(packer)
             
+            if atomic.isDb():
+                self.fields[atomic.getName()] = value
+                
             packer.endUnpack()
             
+    def receiveField(self, field, di):
+        packer = packerPool.get()
+        packer.setUnpackData(di.getRemainingBytes())
+        
+        self.unpackUpdate(packer, field)
+        
+        di.skipBytes(packer.getNumUnpackedBytes())
+        packerPool.release(packer)
+        
+        # We're saved with the next database flush
+        self.dbm.saveDatabaseObject(self)
+        
+    def receiveUpdates(self, di, count):
+        """
+        Apply count field updates read from di, copying the datagram only once,
+        and save us once for all of them
+        """
+        packer = packerPool.get()
+        packer.setUnpackData(di.getRemainingBytes())
+        
+        for n in range(count):
+            field = self.dclass.getFieldByIndex(packer.rawUnpackUint16())
+            if not field:
+                raise Exception("Unknown field in an update of %s" % (self.dclass.getName()))
+                
+            self.unpackUpdate(packer, field)
+            
         di.skipBytes(packer.getNumUnpackedBytes())
+        packerPool.release(packer)
         
-        # This isn't very optimized, but we wanna make sure we don't lose anything
         self.dbm.saveDatabaseObject(self)
         
         
@@ -90,6 +90,13 @@ class DatabaseServer:
             self.dcObjectTypes[dcObjectCount] = dcClass
             self.dcObjectTypeFromName[dcClass.getName()] = dcObjectCount
             
+    def ownsChannel(self, channel):
+        """
+        Is this our channel or the channel of a database object?
+        Objects which left the cache are still ours, we load them back when they're updated.
+        """
+        return channel == DBSERVER_ID or self.manager.hasDatabaseObject(channel)
+        
     def handle(self, channels, sender, code, datagram):
         """
         Handle a message
@@ -125,9 +132,13 @@ class DatabaseServer:
                 else:
                     raise Exception("Unknown message on DBServer channel: %d" % code)
                     
-            if channel in self.manager.cache:
+            elif code in (STATESERVER_OBJECT_UPDATE_FIELD, STATESERVER_OBJECT_UPDATE_FIELD_MULTIPLE):
+                # We load it if it left the cache, so the update is saved.
+                do = self.manager.loadDatabaseObject(channel)
+                if do is None:
+                    continue
+                    
                 di = DatagramIterator(datagram)
-                do = self.manager.cache[channel]
                 
                 if code == STATESERVER_OBJECT_UPDATE_FIELD:
                     # We are asked to update a field
@@ -141,6 +152,17 @@ class DatabaseServer:
                     # We apply the update
                     field = do.dclass.getFieldByIndex(fieldId)
                     do.receiveField(field, di)
+                    
+                else:
+                    # We are asked to update many fields
+                    doId = di.getUint32()
+                    
+                    # Is this sent to the correct object?
+                    if doId != do.doId:
+                        raise Exception("Object %d does not match channel %d" % (doId, do.doId))
+                        
+                    # We apply all the updates, then we're saved once
+                    do.receiveUpdates(di, di.getUint16())
         
     def getStoredValues(self, sender, datagram):
         """
@@ -223,7 +245,7 @@ class DatabaseServer:
                 #print("%s object %d already exists in db objects!" % (do.dclass.getName(), do.doId))
                 return
             #print("Creating %s db object with doId %d!" % (do.dclass.getName(), do.doId))
-            self.stateServer.dbObjects[do.doId] = DistributedObject(do.doId, do.dclass, 0, 0)
+            self.stateServer.addObject(DistributedObject(do.doId, do.dclass, 0, 0), True)
         
     def setStoredValues(self, sender, datagram):
         """
@@ -397,15 +419,26 @@ class DatabaseServer:
             account.update("ESTATE_ID", estate.doId)
             account.update("HOUSE_ID_SET", houseIds)
             if not estate.doId in self.stateServer.dbObjects:
-                self.stateServer.dbObjects[estate.doId] = DistributedObject(estate.doId, estate.dclass, 0, 0)
+                self.stateServer.addObject(DistributedObject(estate.doId, estate.dclass, 0, 0), True)
         else:
             estate = self.manager.loadDatabaseObject(account.fields['ESTATE_ID'])
             houseIds = account.fields["HOUSE_ID_SET"]
             if not estate.doId in self.stateServer.dbObjects:
-                self.stateServer.dbObjects[estate.doId] = DistributedObject(estate.doId, estate.dclass, 0, 0)
+                self.stateServer.addObject(DistributedObject(estate.doId, estate.dclass, 0, 0), True)
 
         avatars = account.fields["ACCOUNT_AV_SET"]
         
+        # We load every house and avatar of the account at once, then every pet of the avatars.
+        objects = self.manager.loadDatabaseObjects([houseId for houseId in houseIds if houseId] + [avDoId for avDoId in avatars if avDoId])
+        
+        petIds = []
+        for avDoId in avatars:
+            avatar = objects.get(avDoId)
+            if avatar and "setPetId" in avatar.fields and avatar.fields["setPetId"][0] != 0:
+                petIds.append(avatar.fields["setPetId"][0])
+                
+        objects.update(self.manager.loadDatabaseObjects(petIds))
+        
         houses = []
         
         # First create all our blank houses.
@@ -416,14 +449,15 @@ class DatabaseServer:
                 house.update("setAvatarId", 0)
                 house.update("setColor", i)
                 houseIds[i] = house.doId
+                objects[house.doId] = house
                 if not house.doId in self.stateServer.dbObjects:
-                    self.stateServer.dbObjects[house.doId] = DistributedObject(house.doId, house.dclass, 0, 0)
+                    self.stateServer.addObject(DistributedObject(house.doId, house.dclass, 0, 0), True)
                 houses.append(house)
             else: # If the house already exists... Just generate and store it.
-                house = self.manager.loadDatabaseObject(houseIds[i])
+                house = objects[houseIds[i]]
                 house.update("setColor", i)
                 if not house.doId in self.stateServer.dbObjects:
-                    self.stateServer.dbObjects[house.doId] = DistributedObject(house.doId, house.dclass, 0, 0)
+                    self.stateServer.addObject(DistributedObject(house.doId, house.dclass, 0, 0), True)
                 houses.append(house)
                 
         pets = []
@@ -433,17 +467,15 @@ class DatabaseServer:
             avDoId = avatars[i]
             
             # If we're missing the avatar for some reason... Skip!
-            if not self.manager.hasDatabaseObject(avDoId):
+            avatar = objects.get(avDoId)
+            if not avatar:
                 continue
-                
-            # Load in our avatar.
-            avatar = self.manager.loadDatabaseObject(avDoId)
             
-            # Load our pet for this avatar in question in.
+            # Get our pet for this avatar in question.
             if "setPetId" in avatar.fields and avatar.fields["setPetId"][0] != 0:
-                pet = self.manager.loadDatabaseObject(avatar.fields["setPetId"][0])
+                pet = objects[avatar.fields["setPetId"][0]]
                 if not pet.doId in self.stateServer.dbObjects:
-                    self.stateServer.dbObjects[pet.doId] = DistributedObject(pet.doId, pet.dclass, 0, 0)
+                    self.stateServer.addObject(DistributedObject(pet.doId, pet.dclass, 0, 0), True)
                 pets.append(pet)
                 
             avPositionIndex = avatar.fields["setPosIndex"][0]
@@ -455,14 +487,14 @@ class DatabaseServer:
                 house.update("setColor", avPositionIndex)
                 houseIds[avPositionIndex] = house.doId
                 if not house.doId in self.stateServer.dbObjects:
-                    self.stateServer.dbObjects[house.doId] = DistributedObject(house.doId, house.dclass, 0, 0)
+                    self.stateServer.addObject(DistributedObject(house.doId, house.dclass, 0, 0), True)
             else: # Update our houses info just in case ours changed!
-                house = self.manager.loadDatabaseObject(houseIds[avPositionIndex])
+                house = objects[houseIds[avPositionIndex]]
                 house.update("setName", avatar.fields["setName"][0])
                 house.update("setAvatarId", avDoId)
                 house.update("setColor", avPositionIndex)
                 if not house.doId in self.stateServer.dbObjects:
-                    self.stateServer.dbObjects[house.doId] = DistributedObject(house.doId, house.dclass, 0, 0)
+                    self.stateServer.addObject(DistributedObject(house.doId, house.dclass, 0, 0), True)
             
         
         # Update our ids just in case a new house was made.
@@ -0,0 +1,133 @@
+import threading, traceback
+
+class DatabaseWriter:
+    """
+    Write-behind saving of DatabaseObjects.
+    Changed objects are only marked dirty. Every interval seconds (or sooner when threshold
+    objects are dirty) we copy each of them once and a background thread saves the copies,
+    so many updates of an object end up in a single copy and a single save.
+    """
+    def __init__(self, backend, reactor, interval, threshold):
+        self.backend = backend
+        self.reactor = reactor
+        self.interval = interval
+        self.threshold = threshold
+
+        # doId -> DatabaseObject changed since we last copied it, only used by the main thread
+        self.dirty = {}
+
+        # doId -> (DatabaseObject, copy of it to save) handed to the writer thread
+        self.pending = {}
+
+        # The same for the objects being saved right now, until they are.
+        self.flushing = {}
+        self.pendingLock = threading.Lock()
+
+        # Only one flush at a time, so an older copy of an object is never saved after a newer one.
+        self.flushLock = threading.Lock()
+
+        self.wakeEvent = threading.Event()
+        self.running = False
+        self.thread = None
+        self.timer = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="DatabaseWriter", daemon=True)
+        self.thread.start()
+
+        # We copy the dirty objects on the main thread, where they change.
+        self.timer = self.reactor.addTimer(self.interval, self.handOff, repeat=True)
+
+    def stop(self):
+        """
+        Stop the background thread and save everything that is still dirty
+        """
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+
+        self.running = False
+        self.wakeEvent.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+        self.flush()
+
+    def run(self):
+        while self.running:
+            self.wakeEvent.wait()
+            self.wakeEvent.clear()
+            self.save()
+
+    def markDirty(self, do):
+        self.dirty[do.doId] = do
+
+        # We don't wait for the interval if a lot of objects changed.
+        if len(self.dirty) >= self.threshold:
+            self.handOff()
+
+    def handOff(self, doIds=None):
+        """
+        Copy the dirty objects, or only the ones in doIds, and wake the writer thread up to save them
+        """
+        if doIds is None:
+            objects = self.dirty
+            self.dirty = {}
+        else:
+            objects = {doId: self.dirty.pop(doId) for doId in doIds if doId in self.dirty}
+
+        if objects:
+            snapshots = {doId: (do, do.snapshot()) for doId, do in objects.items()}
+            with self.pendingLock:
+                self.pending.update(snapshots)
+
+        # We wake it up anyway, it tries the failed saves again.
+        self.wakeEvent.set()
+
+    def get(self, doId):
+        """
+        Get an object waiting to be saved or being saved, or None
+        """
+        do = self.dirty.get(doId)
+        if do is not None:
+            return do
+
+        with self.pendingLock:
+            entry = self.pending.get(doId) or self.flushing.get(doId)
+
+        if entry:
+            return entry[0]
+
+        return None
+
+    def save(self):
+        """
+        Save the copies handed to us
+        """
+        with self.flushLock:
+            with self.pendingLock:
+                self.flushing = self.pending
+                self.pending = {}
+
+            for doId, (do, snapshot) in self.flushing.items():
+                try:
+                    self.backend.save(snapshot)
+                except Exception:
+                    traceback.print_exc()
+
+                    # We try again with the next flush, unless a newer copy is waiting.
+                    with self.pendingLock:
+                        if not doId in self.pending:
+                            self.pending[doId] = (do, snapshot)
+
+            with self.pendingLock:
+                self.flushing = {}
+
+    def flush(self, doIds=None):
+        """
+        Save the dirty objects now, or only the ones in doIds
+        """
+        self.handOff(doIds)
+        self.save()
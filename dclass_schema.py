@@ -0,0 +1,108 @@
+from packer_pool import packerPool
+
+def skipField(packer, field, size):
+    """
+    Validate the value of field in a packer unpacking size bytes, and go past it.
+    We raise if it's truncated or doesn't respect the DC ranges, like unpackArgs would.
+    """
+    packer.beginUnpack(field)
+    packer.unpackValidate()
+    if not packer.endUnpack() or packer.getNumUnpackedBytes() > size:
+        raise Exception("Invalid data for field %s" % (field.getName()))
+
+class DClassSchema:
+    """
+    Everything we need to know about the fields of a dclass, computed once.
+    Going through the Panda3D bindings for every field of every generate is slow,
+    so we keep the fields we iterate over in plain tuples.
+    """
+    def __init__(self, dclass):
+        self.dclass = dclass
+        self.number = dclass.getNumber()
+
+        fields = []
+        for index in range(dclass.getNumInheritedFields()):
+            fields.append(dclass.getInheritedField(index))
+
+        self.fields = tuple(fields)
+
+        # Fields in the order they're packed in a generate.
+        self.requiredFields = tuple(field for field in fields if field.isRequired() and field.asAtomicField())
+        self.requiredBroadcastFields = tuple(field for field in self.requiredFields if field.isBroadcast())
+        self.otherBroadcastFields = tuple(field for field in fields if field.isBroadcast() and not field.isRequired())
+
+        # Which generate sections a field number is packed in.
+        self.requiredNumbers = frozenset(field.getNumber() for field in self.requiredFields)
+        self.requiredBroadcastNumbers = frozenset(field.getNumber() for field in self.requiredBroadcastFields)
+        self.otherBroadcastNumbers = frozenset(field.getNumber() for field in self.otherBroadcastFields)
+
+        # Fields a DistributedObject keeps the value of.
+        self.ramFields = tuple(field for field in fields if (field.isRequired() or field.isRam()) and field.asAtomicField())
+
+        # Where the value of a ram field is stored, by field number
+        self.ramIndex = {field.getNumber(): index for index, field in enumerate(self.ramFields)}
+
+        # Fields a DatabaseObject keeps the value of.
+        self.dbFields = tuple(field for field in fields if field.isDb())
+
+        self.fieldsByNumber = {field.getNumber(): field for field in fields}
+        self.fieldsByName = {field.getName(): field for field in fields}
+
+    def getFieldByIndex(self, index):
+        field = self.fieldsByNumber.get(index)
+        if not field:
+            # This might not be an inherited field, let Panda3D find it.
+            field = self.dclass.getFieldByIndex(index)
+
+        return field
+
+    def readFields(self, di, count):
+        """
+        Read count field numbers and field values from di,
+        and get the field and packed data of each of them without unpacking them.
+        We raise if a field is unknown or its data is invalid.
+        """
+        data = di.getRemainingBytes()
+
+        packer = packerPool.get()
+        packer.setUnpackData(data)
+
+        fields = []
+        for n in range(count):
+            field = self.getFieldByIndex(packer.rawUnpackUint16())
+            if not field:
+                raise Exception("Unknown field in an update of %s" % (self.dclass.getName()))
+
+            start = packer.getNumUnpackedBytes()
+            skipField(packer, field, len(data))
+
+            fields.append((field, data[start:packer.getNumUnpackedBytes()]))
+
+        di.skipBytes(packer.getNumUnpackedBytes())
+        packerPool.release(packer)
+
+        return fields
+
+# Every schema we know, by dclass number
+schemas = {}
+
+def loadSchemas(dcFile):
+    """
+    Compute the schema of every dclass of a DC file
+    """
+    schemas.clear()
+
+    for i in range(dcFile.getNumClasses()):
+        dclass = dcFile.getClass(i)
+        schemas[dclass.getNumber()] = DClassSchema(dclass)
+
+def getSchema(dclass):
+    """
+    Get the schema of a dclass, it is computed if it wasn't loaded with the DC file
+    """
+    schema = schemas.get(dclass.getNumber())
+    if not schema:
+        schema = DClassSchema(dclass)
+        schemas[schema.number] = schema
+
+    return schema
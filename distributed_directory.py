@@ -4,6 +4,7 @@ from panda3d.direct import DCPacker
 from distributed_object import DistributedObject
     
 class DistributedDirectory(DistributedObject):
+    __slots__ = ()
 
     def __init__(self, doId, dclass, parentId, zoneId):
         super().__init__(doId, dclass, parentId, zoneId)
\ No newline at end of file
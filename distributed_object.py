@@ -1,113 +1,233 @@
-from panda3d.core import Datagram
-from panda3d.direct import DCPacker
+from dclass_schema import getSchema, skipField
+from packer_pool import packerPool
     
 class DistributedObject:
+    # We can have a lot of these, so we keep them small.
+    __slots__ = ("doId", "dclass", "schema", "parentId", "zoneId", "senders", "values",
+                 "packedRequired", "packedRequiredBroadcast", "packedOther")
 
     def __init__(self, doId, dclass, parentId, zoneId):
         self.doId = doId
         self.dclass = dclass
+        self.schema = getSchema(dclass)
         self.parentId = parentId
         self.zoneId = zoneId
         
-        self.senders = []
-        self.senderId = None
+        self.senders = ()
         
-        self.fields = {}
-        
-        for index in range(self.dclass.getNumInheritedFields()):
-            field = self.dclass.getInheritedField(index)
-            if (field.isRequired() or field.isRam()) and field.asAtomicField():
-                self.fields[field.getNumber()] = None
+        # Ram field values, in the order of the schema ram fields.
+        # They're kept packed (bytes) until someone asks for them.
+        self.values = [None] * len(self.schema.ramFields)
+            
+        # Packed generate sections, None when they must be packed again.
+        self.packedRequired = None
+        self.packedRequiredBroadcast = None
+        self.packedOther = None
 
     def update(self, field, *values):
-        self.fields[self.dclass.getFieldByName(field).getNumber()] = values
+        field = self.schema.fieldsByName[field]
         
-    def packField(self, dg, field):
-        packer = DCPacker()
+        packer = packerPool.get()
         packer.beginPack(field)
+        field.packArgs(packer, values)
+        packer.endPack()
+        data = packer.getBytes()
+        packerPool.release(packer)
         
-        if field.getNumber() in self.fields:
-            field.packArgs(packer, self.fields[field.getNumber()])
-        else:
-            packer.packDefaultValue()
+        self.setField(field.getNumber(), data)
+        
+    def getValue(self, field):
+        """
+        Unpack the value of a field, or None if we don't have it
+        """
+        field = self.schema.fieldsByName[field]
+        
+        data = self.getField(field.getNumber())
+        if data is None:
+            return None
             
-        packer.endPack()
+        packer = packerPool.get()
+        packer.setUnpackData(data)
+        packer.beginUnpack(field)
+        value = field.unpackArgs(packer)
+        packer.endUnpack()
+        packerPool.release(packer)
+        
+        return value
+        
+    def getField(self, number):
+        """
+        Get the packed value of a field, or None if we don't have it
+        """
+        index = self.schema.ramIndex.get(number)
+        if index is None:
+            return None
+            
+        return self.values[index]
+        
+    def setField(self, number, data):
+        # We only keep the ram fields.
+        index = self.schema.ramIndex.get(number)
+        if index is None:
+            return
+            
+        self.values[index] = data
+        
+        # We only repack the sections this field is in.
+        if number in self.schema.requiredNumbers:
+            self.packedRequired = None
+            
+            if number in self.schema.requiredBroadcastNumbers:
+                self.packedRequiredBroadcast = None
+                
+        elif number in self.schema.otherBroadcastNumbers:
+            self.packedOther = None
+            
+    def packFields(self, packer, fields, withNumbers=False):
+        """
+        Pack the values (or the default values) of fields into a single packer
+        """
+        for field in fields:
+            if withNumbers:
+                packer.rawPackUint16(field.getNumber())
+                
+            packer.beginPack(field)
+            
+            data = self.getField(field.getNumber())
+            if data is not None:
+                # It's already packed.
+                packer.packLiteralValue(data)
+            else:
+                packer.packDefaultValue()
+                
+            packer.endPack()
+        
+    def packField(self, dg, field):
+        packer = packerPool.get()
+        self.packFields(packer, (field,))
         dg.appendData(packer.getBytes())
+        packerPool.release(packer)
+        
+    def packSection(self, fields):
+        packer = packerPool.get()
+        self.packFields(packer, fields)
+        data = packer.getBytes()
+        packerPool.release(packer)
+        
+        return data
 
     def packRequired(self, dg):
-        for index in range(self.dclass.getNumInheritedFields()):
-            field = self.dclass.getInheritedField(index)
-            if field.isRequired() and field.asAtomicField():
-                self.packField(dg, field)
+        if self.packedRequired is None:
+            self.packedRequired = self.packSection(self.schema.requiredFields)
+            
+        dg.appendData(self.packedRequired)
 
     def packRequiredBroadcast(self, dg):
-        for index in range(self.dclass.getNumInheritedFields()):
-            field = self.dclass.getInheritedField(index)
-            if (field.isRequired() and field.isBroadcast()) and field.asAtomicField():
-                self.packField(dg, field)
+        if self.packedRequiredBroadcast is None:
+            self.packedRequiredBroadcast = self.packSection(self.schema.requiredBroadcastFields)
+            
+        dg.appendData(self.packedRequiredBroadcast)
 
     def packOther(self, dg):
-        dg2 = Datagram()
-        count = 0
+        if self.packedOther is None:
+            self.packedOther = self.packOtherSection()
+            
+        dg.appendData(self.packedOther)
         
-        for index in range(self.dclass.getNumInheritedFields()):
-            field = self.dclass.getInheritedField(index)
-            if field.isBroadcast() and not field.isRequired() and self.fields.get(field.getNumber(), None) is not None:
-                count += 1
-                
-                dg2.addUint16(field.getNumber())
-                self.packField(dg2, field)
-                
-        dg.addUint16(count)
-        dg.appendData(dg2.getMessage())
+    def packOtherSection(self):
+        fields = [field for field in self.schema.otherBroadcastFields if self.getField(field.getNumber()) is not None]
         
+        packer = packerPool.get()
+        packer.rawPackUint16(len(fields))
+        self.packFields(packer, fields, True)
+        data = packer.getBytes()
+        packerPool.release(packer)
         
-    def receiveField(self, field, di):
-        packer = DCPacker()
-        packer.setUnpackData(di.getRemainingBytes())
+        return data
         
+    def unpackField(self, packer, data, field):
+        """
+        Read a field from a packer unpacking data, keeping its packed bytes
+        """
+        # We don't unpack the values, we only check them and find where they end.
         molecular = field.asMolecularField()
         if molecular:
-            for n in range(molecular.getNumAtomics()):
-                atomic = molecular.getAtomic(n)
-                
-                packer.beginUnpack(atomic)
-                value = atomic.unpackArgs(packer)
-                
-                if atomic.getNumber() in self.fields:
-                    self.fields[atomic.getNumber()] = value
-                    
-                packer.endUnpack()
-                
+            atomics = [molecular.getAtomic(n) for n in range(molecular.getNumAtomics())]
         else:
-            packer.beginUnpack(field)
-            value = field.unpackArgs(packer)
+            atomics = (field,)
             
-            if field.getNumber() in self.fields:
-                self.fields[field.getNumber()] = value
+        for atomic in atomics:
+            start = packer.getNumUnpackedBytes()
             
-            packer.endUnpack()
+            skipField(packer, atomic, len(data))
             
+            if atomic.getNumber() in self.schema.ramIndex:
+                self.setField(atomic.getNumber(), data[start:packer.getNumUnpackedBytes()])
+        
+    def receiveFields(self, di, fields=None):
+        """
+        Read fields, or the field numbers and fields of an other section if fields is None,
+        copying the datagram only once
+        """
+        data = di.getRemainingBytes()
+        
+        packer = packerPool.get()
+        packer.setUnpackData(data)
+        
+        if fields is None:
+            self.unpackNumberedFields(packer, data, packer.rawUnpackUint16())
+        else:
+            for field in fields:
+                self.unpackField(packer, data, field)
+                
         di.skipBytes(packer.getNumUnpackedBytes())
+        packerPool.release(packer)
+        
+    def unpackNumberedFields(self, packer, data, count):
+        """
+        Read count field numbers and fields from a packer unpacking data,
+        and get the field and packed data of each of them
+        """
+        updates = []
+        for n in range(count):
+            field = self.schema.getFieldByIndex(packer.rawUnpackUint16())
+            if not field:
+                raise Exception("Unknown field in an update of %s" % (self.dclass.getName()))
+                
+            start = packer.getNumUnpackedBytes()
+            self.unpackField(packer, data, field)
+            updates.append((field, data[start:packer.getNumUnpackedBytes()]))
+            
+        return updates
+        
+    def receiveUpdates(self, di, count):
+        """
+        Apply count field updates read from di, copying the datagram only once,
+        and get the field and packed data of each of them
+        """
+        data = di.getRemainingBytes()
+        
+        packer = packerPool.get()
+        packer.setUnpackData(data)
+        
+        updates = self.unpackNumberedFields(packer, data, count)
+        
+        di.skipBytes(packer.getNumUnpackedBytes())
+        packerPool.release(packer)
+        
+        return updates
+        
+    def receiveField(self, field, di):
+        self.receiveFields(di, (field,))
         
     def receiveRequired(self, di):
-        for index in range(self.dclass.getNumInheritedFields()):
-            field = self.dclass.getInheritedField(index)
-            if field.isRequired() and field.asAtomicField():
-                self.receiveField(field, di)
+        self.receiveFields(di, self.schema.requiredFields)
         
     def receiveRequiredBroadcast(self, di):
-        for index in range(self.dclass.getNumInheritedFields()):
-            field = self.dclass.getInheritedField(index)
-            if field.isRequired() or field.asAtomicField():
-                self.receiveField(field, di)
+        self.receiveFields(di, self.schema.requiredBroadcastFields)
         
     def receiveOther(self, di):
-        for n in range(di.getUint16()):
-            index = di.getUint16()
-            
-            field = self.dclass.getFieldByIndex(index)
-            self.receiveField(field, di)
+        self.receiveFields(di)
 
     def __repr__(self):
         return "<" + self.dclass.getName() + " instance at " + str(self.doId) + ", in " + str(self.parentId) + " zone " + str(self.zoneId) + ">"
\ No newline at end of file
@@ -0,0 +1,179 @@
+import struct
+
+class FrameDecoder:
+    """
+    Split a stream into its uint16 length-prefixed frames.
+    Instead of slicing the consumed frames out of the buffer every time,
+    we keep a read offset and only compact the buffer once in a while.
+    """
+    def __init__(self, compactThreshold=65536):
+        self.buffer = bytearray()
+        self.offset = 0
+
+        # How much consumed data we keep before moving the rest to the front.
+        self.compactThreshold = compactThreshold
+
+    def compact(self):
+        if self.offset == len(self.buffer):
+            self.buffer.clear()
+            self.offset = 0
+
+        elif self.offset >= self.compactThreshold:
+            del self.buffer[:self.offset]
+            self.offset = 0
+
+    def feed(self, data):
+        """
+        Append received data and yield every complete frame as a memoryview.
+        The frames are only valid until the next one is yielded, copy them if you need to keep them.
+        """
+        buffer = self.buffer
+        self.compact()
+        buffer += data
+
+        with memoryview(buffer) as view:
+            while len(buffer) - self.offset >= 2:
+                start = self.offset + 2
+                end = start + struct.unpack_from("<H", buffer, self.offset)[0]
+                if len(buffer) < end:
+                    break
+
+                self.offset = end
+
+                frame = view[start:end]
+                try:
+                    yield frame
+                finally:
+                    frame.release()
+
+class SendQueue:
+    """
+    Outbound frames of a connection.
+    Frames are appended to a single buffer which is flushed with one send
+    at the end of the reactor tick, and whatever the socket couldn't take
+    is sent again once it's writable.
+    While more than highWaterMark bytes are waiting, we stop reading from the
+    connection, so a peer which doesn't read can't make us queue forever.
+    """
+    def __init__(self, sock, reactor, highWaterMark=1 << 20):
+        self.sock = sock
+        self.reactor = reactor
+        self.buffer = bytearray()
+
+        self.highWaterMark = highWaterMark
+        self.lowWaterMark = highWaterMark // 2
+
+        self.scheduled = False
+        self.writing = False
+        self.paused = False
+        self.closed = False
+
+        # We're sending what's left before closing the socket.
+        self.closing = False
+        self.closeTimer = None
+
+    def push(self, data):
+        """
+        Queue a frame
+        """
+        if self.closed or self.closing:
+            return
+
+        self.buffer += struct.pack("<H", len(data))
+        self.buffer += data
+
+        # If we're waiting for the socket to be writable, it will be flushed anyway.
+        if not self.scheduled and not self.writing:
+            self.scheduled = True
+            self.reactor.callSoon(self.flush)
+
+    def isFull(self):
+        return len(self.buffer) >= self.highWaterMark
+
+    def flush(self):
+        """
+        Send as much as we can
+        """
+        self.scheduled = False
+        if self.closed or not self.buffer:
+            return
+
+        try:
+            sent = self.sock.send(self.buffer)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError:
+            # The connection is gone, it will be dropped on the reading side.
+            print("Tried to send to connection %s, But connection was closed!" % (str(self.sock)))
+            self.discard()
+            if self.closing:
+                self.closeSocket()
+            return
+
+        del self.buffer[:sent]
+
+        # We wait for the socket to be writable if we have some leftovers.
+        if self.buffer and not self.writing:
+            self.writing = True
+            self.reactor.setWriter(self.sock, self.flush)
+
+        elif not self.buffer and self.writing:
+            self.writing = False
+            self.reactor.setWriter(self.sock, None)
+
+        if self.closing:
+            # Everything was sent, we're done with it.
+            if not self.buffer:
+                self.closeSocket()
+            return
+
+        if not self.paused and len(self.buffer) >= self.highWaterMark:
+            self.paused = True
+            self.reactor.setReading(self.sock, False)
+
+        elif self.paused and len(self.buffer) <= self.lowWaterMark:
+            self.paused = False
+            self.reactor.setReading(self.sock, True)
+
+    def discard(self):
+        """
+        Drop everything and refuse new frames
+        """
+        self.closed = True
+        self.buffer.clear()
+
+        if self.writing:
+            self.writing = False
+            self.reactor.setWriter(self.sock, None)
+
+        if self.paused:
+            self.paused = False
+            self.reactor.setReading(self.sock, True)
+
+    def close(self, timeout=5.0):
+        """
+        Refuse new frames, and close the socket once what's left is sent,
+        or after timeout seconds if the peer doesn't read it.
+        The socket stays registered for writing until then.
+        """
+        if self.closed or self.closing:
+            return
+
+        self.closing = True
+        self.flush()
+        if self.closed:
+            return
+
+        # We don't read from it anymore.
+        self.paused = False
+        self.reactor.setReading(self.sock, False)
+        self.closeTimer = self.reactor.addTimer(timeout, self.closeSocket)
+
+    def closeSocket(self):
+        if self.closeTimer:
+            self.closeTimer.cancel()
+            self.closeTimer = None
+
+        self.discard()
+        self.reactor.unregister(self.sock)
+        self.sock.close()
@@ -0,0 +1,91 @@
+import argparse, tracemalloc
+
+from panda3d.core import Filename
+from panda3d.direct import DCFile, DCPacker
+
+from dclass_schema import getSchema, loadSchemas
+from distributed_object import DistributedObject
+
+class LegacyDistributedObject:
+    """
+    The dict based layout DistributedObject used to have, for comparison.
+    """
+    def __init__(self, doId, dclass, parentId, zoneId):
+        self.doId = doId
+        self.dclass = dclass
+        self.parentId = parentId
+        self.zoneId = zoneId
+
+        self.senders = []
+        self.senderId = None
+
+        self.fields = {}
+
+        for field in getSchema(dclass).ramFields:
+            self.fields[field.getNumber()] = None
+
+def fillLegacy(do, packer):
+    # The old layout kept the unpacked values.
+    for field in getSchema(do.dclass).ramFields:
+        packer.setUnpackData(field.getDefaultValue())
+        packer.beginUnpack(field)
+        do.fields[field.getNumber()] = field.unpackArgs(packer)
+        packer.endUnpack()
+
+def fillPacked(do, packer):
+    # We keep the packed bytes, each object gets its own copy like it would from a datagram.
+    for field in do.schema.ramFields:
+        do.setField(field.getNumber(), bytes(bytearray(field.getDefaultValue())))
+
+def measure(cls, fill, dclass, count):
+    """
+    Get how many bytes an instance of cls takes on average,
+    with the default value of every required and ram field filled in
+    """
+    packer = DCPacker()
+
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+
+    objects = [cls(100000000 + i, dclass, 4618, 2000) for i in range(count)]
+    for do in objects:
+        # One AI generated them, in whichever container this layout uses.
+        do.senders = type(do.senders)([4000])
+        fill(do, packer)
+
+    size = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+
+    # We don't count the list holding them.
+    return (size - 8 * count) / count
+
+def main():
+    parser = argparse.ArgumentParser(description="Report the memory used by each DistributedObject.")
+    parser.add_argument("dcFiles", nargs="*", default=["otp.dc", "toon.dc"])
+    parser.add_argument("--dclass", action="append", help="dclass to measure (can be given many times)")
+    parser.add_argument("--count", type=int, default=10000)
+    args = parser.parse_args()
+
+    dc = DCFile()
+    for dcFileName in args.dcFiles:
+        if not dc.read(Filename(dcFileName)):
+            print("Could not read dc file: %s" % (dcFileName))
+            return
+
+    loadSchemas(dc)
+
+    classNames = args.dclass or ["DistributedToon", "DistributedSuit", "DistributedEstate", "DistributedHouse", "DistributedPet"]
+
+    print("%-24s %8s %10s %10s" % ("dclass", "fields", "before", "after"))
+    for className in classNames:
+        dclass = dc.getClassByName(className)
+        if not dclass:
+            print("Unknown dclass %s, skipping it." % (className))
+            continue
+
+        before = measure(LegacyDistributedObject, fillLegacy, dclass, args.count)
+        after = measure(DistributedObject, fillPacked, dclass, args.count)
+        print("%-24s %8d %9.0fB %9.0fB" % (className, len(getSchema(dclass).ramFields), before, after))
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,9 @@
 from panda3d.core import Datagram, DatagramIterator
+from framing import FrameDecoder, SendQueue
+from range_map import RangeMap
 from msgtypes import *
 
 import socket
-import struct
 
 class MDClient:
     def __init__(self, md, sock, addr):
@@ -13,27 +14,28 @@ class MDClient:
         # Quick access to OTP
         self.otp = self.md.otp
         
-        self.buffer = bytearray()
+        self.decoder = FrameDecoder()
+        self.sendQueue = SendQueue(sock, self.otp.reactor, self.otp.sendQueueHighWater)
         
         self.connectionNames = []
         self.connectionURLs = []
         self.channels = set()
+        self.ranges = []
         self.postRemove = []
 
     def onLost(self):
+        # We're not listening to anything anymore
+        for channel in self.channels:
+            self.md.unsubscribe(self, channel)
+            
+        for low, high in self.ranges:
+            self.md.unsubscribeRange(self, low, high)
+            
         for x in self.postRemove:
             self.onDatagram(Datagram(x))
 
     def onData(self, data):
-        self.buffer += data
-        while len(self.buffer) >= 2:
-            length = struct.unpack("<H", self.buffer[:2])[0]
-            if len(self.buffer) < length+2:
-                break
-                
-            packet = self.buffer[2:length+2]
-            self.buffer = self.buffer[length+2:]
-        
+        for packet in self.decoder.feed(data):
             self.onDatagram(Datagram(bytes(packet)))
 
     def onDatagram(self, dg):
@@ -63,13 +65,33 @@ class MDClient:
             if code == CONTROL_SET_CHANNEL:
                 channel = di.getUint64()
                 self.channels.add(channel)
+                self.md.subscribe(self, channel)
                 #print("Registered channel %d for %s:%d" % (channel, self.addr[0], self.addr[1]))
                 
             elif code == CONTROL_REMOVE_CHANNEL:
                 channel = di.getUint64()
                 self.channels.remove(channel)
+                self.md.unsubscribe(self, channel)
                 #print("Unregistered channel %d for %s:%d" % (channel, self.addr[0], self.addr[1]))
                 
+            elif code == CONTROL_ADD_RANGE:
+                low = di.getUint64()
+                high = di.getUint64()
+                if low > high:
+                    print("Ignoring inverted channel range %d-%d!" % (low, high))
+                    return
+                    
+                self.ranges.append((low, high))
+                self.md.subscribeRange(self, low, high)
+                
+            elif code == CONTROL_REMOVE_RANGE:
+                low = di.getUint64()
+                high = di.getUint64()
+                # We only remove the ranges we added.
+                if (low, high) in self.ranges:
+                    self.ranges.remove((low, high))
+                    self.md.unsubscribeRange(self, low, high)
+                
             elif code == CONTROL_ADD_POST_REMOVE:
                 message = di.getBlob()
                 self.postRemove.append(message)
@@ -89,13 +111,12 @@ class MDClient:
             sender = di.getUint64()
             code = di.getUint16()
             
-            for client in self.md.clients:
+            for client in self.md.getSubscribers(channels):
                 # We're not sending back our messages
                 if client == self:
                     continue
                     
-                if client.channels.intersection(channels):
-                    client.sendDatagram(dg)
+                client.sendDatagram(dg)
 
             # We send this message to OTP
             self.otp.handleMessage(channels, sender, code, Datagram(di.getRemainingBytes()))
@@ -104,11 +125,11 @@ class MDClient:
         return self.connectionNames[0] == "UberDog"
         
     def getPrimaryChannel(self):
-        return list(self.channels)[0]
+        # We might only have ranges.
+        return next(iter(self.channels), None)
 
     def sendDatagram(self, dg):
-        self.sock.send(struct.pack("<H", dg.getLength()))
-        self.sock.send(bytes(dg))
+        self.sendQueue.push(dg.getMessage())
 
 class MessageDirector:
     def __init__(self, otp):
@@ -123,6 +144,12 @@ class MessageDirector:
         # MD Clients
         self.clients = []
         
+        # Channel subscriptions, channel -> set of MD clients
+        self.subscribers = {}
+        
+        # Channel range subscriptions
+        self.rangeSubscribers = RangeMap()
+        
     def getUberdog(self):
         for client in self.clients:
             if client.isUberdog():
@@ -130,6 +157,41 @@ class MessageDirector:
         
         return None
 
+    def subscribe(self, client, channel):
+        if not channel in self.subscribers:
+            self.subscribers[channel] = set()
+            
+        self.subscribers[channel].add(client)
+        
+    def unsubscribe(self, client, channel):
+        clients = self.subscribers.get(channel)
+        if not clients:
+            return
+            
+        clients.discard(client)
+        if not clients:
+            del self.subscribers[channel]
+            
+    def subscribeRange(self, client, low, high):
+        self.rangeSubscribers.add(low, high, client)
+        
+    def unsubscribeRange(self, client, low, high):
+        self.rangeSubscribers.remove(low, high, client)
+            
+    def getSubscribers(self, channels):
+        """
+        Get every MD client listening to at least one of these channels,
+        each of them only once
+        """
+        clients = set()
+        for channel in channels:
+            if channel in self.subscribers:
+                clients.update(self.subscribers[channel])
+                
+            clients.update(self.rangeSubscribers.get(channel))
+                
+        return clients
+
     def sendMessage(self, channels, sender, code, datagram):
         """
         Send a message to MD
@@ -145,9 +207,8 @@ class MessageDirector:
         dg.appendData(datagram.getMessage())
         
         # We send the message to any listening
-        for client in self.clients:
-            if client.channels.intersection(channels):
-                client.sendDatagram(dg)
+        for client in self.getSubscribers(channels):
+            client.sendDatagram(dg)
         
         # Now we send this message to OTP
         # Please note we technically shouldn't transmit
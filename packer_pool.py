@@ -0,0 +1,24 @@
+from panda3d.direct import DCPacker
+
+class PackerPool:
+    """
+    DCPackers ready to be used again,
+    so we don't have to allocate a new one for every field we pack.
+    """
+    def __init__(self, maxSize=16):
+        self.packers = []
+        self.maxSize = maxSize
+
+    def get(self):
+        if self.packers:
+            return self.packers.pop()
+
+        return DCPacker()
+
+    def release(self, packer):
+        packer.clearData()
+        if len(self.packers) < self.maxSize:
+            self.packers.append(packer)
+
+# The pool everyone uses
+packerPool = PackerPool()
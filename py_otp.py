@@ -1,6 +1,6 @@
-import os, socket, select
+import atexit, os, signal, socket, sys
 
-from panda3d.core import DSearchPath, Filename, VirtualFileSystem
+from panda3d.core import ConfigVariableBool, ConfigVariableDouble, ConfigVariableInt, DSearchPath, Filename, VirtualFileSystem
 from panda3d.direct import DCFile
 
 from message_director import MessageDirector, MDClient
@@ -9,12 +9,28 @@ from client_agent import ClientAgent
 from client import Client
 from database_server import DatabaseServer
 from event_server import EventServer
+from reactor import Reactor
+from async_reactor import AsyncioReactor
+from dclass_schema import loadSchemas
 
 class PyOTP:
     def __init__(self):
         # Every socket client (makes the code faster)
         self.clients = {}
         
+        # Every socket is read into this buffer, the clients copy what they need out of it.
+        self.recvBuffer = bytearray(ConfigVariableInt("socket-recv-buffer-size", 65536).getValue())
+        self.recvView = memoryview(self.recvBuffer)
+        
+        # How much outgoing data a connection can queue before we stop reading from it.
+        self.sendQueueHighWater = ConfigVariableInt("send-queue-high-water", 1 << 20).getValue()
+        
+        # Our event loop, every socket is registered to it.
+        if ConfigVariableBool("want-asyncio", False).getValue():
+            self.reactor = AsyncioReactor(ConfigVariableBool("want-uvloop", True).getValue())
+        else:
+            self.reactor = Reactor(ConfigVariableDouble("reactor-max-timeout", 1.0).getValue())
+        
         # DC File
         self.dc = DCFile()
         
@@ -50,60 +66,115 @@ class PyOTP:
         self.stateServer = StateServer(self)
         self.databaseServer = DatabaseServer(self)
         
+        # Every service routed messages can go to, each one tells which channels it owns.
+        self.services = (self.stateServer, self.clientAgent, self.databaseServer)
+        
+        # We can now accept connections.
+        self.listen()
         
     def handleMessage(self, channels, sender, code, datagram):
         """
-        Transmit a received message from MD to SS, CA and DBSS
+        Transmit a received message from MD to the services owning its channels
         """
-        self.stateServer.handle(channels, sender, code, datagram)
-        self.clientAgent.handle(channels, sender, code, datagram)
-        self.databaseServer.handle(channels, sender, code, datagram)
+        for service in self.services:
+            # We check right before handling, a service can take a channel
+            # while another one handles the message (e.g. a generate).
+            owned = [channel for channel in channels if service.ownsChannel(channel)]
+            if owned:
+                service.handle(owned, sender, code, datagram)
         
         
     def flush(self):
         """
-        Do some socket magic
+        Wait for socket events and timers, then dispatch them
         """
-        # TODO: use socketserver or something different.
-        # We are very limited by select here
-        
-        r, w, x = select.select([self.messageDirector.sock, self.clientAgent.sock, self.eventServer.sock] + list(self.clients), [], [], 0)
-        for sock in r:
-            if sock == self.messageDirector.sock:
-                sock, addr = sock.accept()
-                self.clients[sock] = MDClient(self.messageDirector, sock, addr)
-                self.messageDirector.clients.append(self.clients[sock])
-                
-            elif sock == self.clientAgent.sock:
-                sock, addr = sock.accept()
-                self.clients[sock] = Client(self.clientAgent, sock, addr)
-                self.clientAgent.clients.append(self.clients[sock])
-                
-            elif sock == self.eventServer.sock:
-                data, addr = sock.recvfrom(2048)
-                self.eventServer.onData(data)
+        self.reactor.poll()
+        
+    def run(self):
+        """
+        Run the OTP forever
+        """
+        # When we're asked to stop (run.py terminates us), we exit through shutdown so what changed is saved.
+        # We can't catch a SIGKILL or a TerminateProcess, those lose up to database-flush-interval seconds of changes.
+        for name in ("SIGTERM", "SIGBREAK"):
+            if hasattr(signal, name):
+                signal.signal(getattr(signal, name), self.onStopSignal)
                 
-            else:
-                client = self.clients[sock]
-                try:
-                    data = sock.recv(2048)
-                except socket.error:
-                    data = None
-                    
-                if not data:
-                    print("Dropping client %s!" % (str(self.clients[sock])))
-                    del self.clients[sock]
-                    
-                    if type(client) == MDClient:
-                        self.messageDirector.clients.remove(client)
-                        
-                    elif type(client) == Client:
-                        self.clientAgent.clients.remove(client)
-                    
-                    client.onLost()
-                    
-                else:
-                    client.onData(data)
+        atexit.register(self.shutdown)
+        
+        try:
+            self.reactor.run()
+        finally:
+            self.shutdown()
+            
+    def onStopSignal(self, signum, frame):
+        # We leave the reactor, run saves everything before we exit.
+        sys.exit(0)
+        
+    def shutdown(self):
+        """
+        Save what we have to before we exit, it's fine to call it more than once
+        """
+        self.databaseServer.manager.shutdown()
+        
+    def listen(self):
+        """
+        Register our listening sockets to the reactor
+        """
+        self.reactor.listen(self.messageDirector.sock, self.onMessageDirectorAccept)
+        self.reactor.listen(self.clientAgent.sock, self.onClientAgentAccept)
+        self.reactor.listenDatagram(self.eventServer.sock, self.eventServer.onData)
+        
+    def onMessageDirectorAccept(self, sock, addr):
+        self.addClient(sock, MDClient(self.messageDirector, sock, addr))
+        self.messageDirector.clients.append(self.clients[sock])
+        
+    def onClientAgentAccept(self, sock, addr):
+        self.addClient(sock, Client(self.clientAgent, sock, addr))
+        self.clientAgent.clients.append(self.clients[sock])
+        
+    def addClient(self, sock, client):
+        sock.setblocking(False)
+        self.clients[sock] = client
+        self.reactor.register(sock, lambda: self.onClientData(sock))
+        
+    def removeClient(self, sock):
+        """
+        Forget about a socket client, without closing it
+        """
+        client = self.clients.pop(sock, None)
+        
+        # Nothing will be sent anymore, unless it's sending what's left before closing.
+        if not client or not client.sendQueue.closing:
+            self.reactor.unregister(sock)
+            if client:
+                client.sendQueue.discard()
+        
+        if type(client) == MDClient:
+            self.messageDirector.clients.remove(client)
+            
+        elif type(client) == Client:
+            self.clientAgent.clients.remove(client)
+            
+        return client
+        
+    def onClientData(self, sock):
+        client = self.clients[sock]
+        try:
+            size = sock.recv_into(self.recvBuffer)
+        except BlockingIOError:
+            return
+        except socket.error:
+            size = 0
+            
+        if not size:
+            print("Dropping client %s!" % (str(client)))
+            self.removeClient(sock)
+            sock.close()
+            client.onLost()
+            
+        else:
+            client.onData(self.recvView[:size])
                     
     def readDCFile(self, dcFileNames = None):
         """
@@ -158,11 +229,12 @@ class PyOTP:
             if number >= 0:
                 self.dclassesByNumber[number] = dclass
                 
+        # We compute the field schemas of every dclass now, once.
+        loadSchemas(dcFile)
+                
         self.dc = dcFile
                     
 
 if __name__ == "__main__":
     otp = PyOTP()
-    
-    while True:
-        otp.flush()
\ No newline at end of file
+    otp.run()
\ No newline at end of file
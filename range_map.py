@@ -0,0 +1,75 @@
+from bisect import bisect_left, bisect_right
+from collections import Counter
+
+class RangeMap:
+    """
+    Sorted-interval index of who is subscribed to which channel ranges.
+    The channels are split in segments where the subscribers don't change,
+    segment i goes from bounds[i] up to bounds[i + 1] (excluded),
+    so a lookup is a single binary search whatever the ranges are.
+    Each segment counts how many of its ranges every subscriber has,
+    so overlapping ranges of the same subscriber can be removed one by one.
+    """
+    def __init__(self):
+        self.bounds = []
+        self.values = []
+
+    def split(self, point):
+        """
+        Make sure a segment starts at point, and return its index
+        """
+        i = bisect_left(self.bounds, point)
+        if i < len(self.bounds) and self.bounds[i] == point:
+            return i
+
+        # The new segment has the same subscribers as the one we're splitting.
+        self.bounds.insert(i, point)
+        self.values.insert(i, Counter(self.values[i - 1]) if i else Counter())
+        return i
+
+    def merge(self, start, end):
+        # We join the neighbouring segments which ended up with the same subscribers.
+        for i in reversed(range(max(start, 1), min(end + 1, len(self.bounds)))):
+            if self.values[i] == self.values[i - 1]:
+                del self.bounds[i]
+                del self.values[i]
+
+        if self.values and not self.values[0]:
+            del self.bounds[0]
+            del self.values[0]
+
+    def add(self, low, high, item):
+        """
+        Subscribe item to every channel from low to high (included)
+        """
+        start = self.split(low)
+        end = self.split(high + 1)
+        for i in range(start, end):
+            self.values[i][item] += 1
+
+        self.merge(start, end)
+
+    def remove(self, low, high, item):
+        """
+        Unsubscribe item from every channel from low to high (included)
+        """
+        start = self.split(low)
+        end = self.split(high + 1)
+        for i in range(start, end):
+            count = self.values[i][item] - 1
+            if count > 0:
+                self.values[i][item] = count
+            else:
+                del self.values[i][item]
+
+        self.merge(start, end)
+
+    def get(self, channel):
+        """
+        Get the subscribers of a channel
+        """
+        i = bisect_right(self.bounds, channel) - 1
+        if i < 0:
+            return ()
+
+        return self.values[i]
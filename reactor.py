@@ -0,0 +1,179 @@
+import heapq, itertools, selectors, time
+
+class Timer:
+    def __init__(self, deadline, callback, interval):
+        self.deadline = deadline
+        self.callback = callback
+        self.interval = interval
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class Reactor:
+    """
+    Wait on every registered socket with the best selector available for
+    this platform (epoll, kqueue...), instead of polling them all with select().
+    Sockets stay registered between calls, so a wakeup only costs us the
+    sockets which are actually ready.
+    """
+    def __init__(self, maxTimeout=1.0):
+        self.selector = selectors.DefaultSelector()
+
+        # The longest we're gonna block when no timer is pending.
+        self.maxTimeout = maxTimeout
+
+        # Timers, as a heap of (deadline, sequence, Timer)
+        self.timers = []
+        self.timerSequence = itertools.count()
+
+        # Callbacks to run at the end of the current tick.
+        self.pending = []
+
+    def register(self, sock, onRead):
+        """
+        Call onRead() whenever sock has something to read.
+        """
+        self.selector.register(sock, selectors.EVENT_READ, (onRead, None, True))
+
+    def listen(self, sock, onAccept):
+        """
+        Call onAccept(sock, addr) for every new connection on a listening socket.
+        """
+        def accept():
+            conn, addr = sock.accept()
+            onAccept(conn, addr)
+
+        self.register(sock, accept)
+
+    def listenDatagram(self, sock, onData):
+        """
+        Call onData(data) for every datagram received on an UDP socket.
+        """
+        def receive():
+            data, addr = sock.recvfrom(2048)
+            onData(data)
+
+        self.register(sock, receive)
+
+    def unregister(self, sock):
+        """
+        Stop watching sock. Does nothing if it was not registered.
+        """
+        try:
+            self.selector.unregister(sock)
+        except (KeyError, ValueError):
+            pass
+
+    def setWriter(self, sock, onWrite):
+        """
+        Call onWrite() whenever sock can be written to,
+        or stop watching for it if onWrite is None.
+        """
+        self.modify(sock, onWrite=onWrite)
+
+    def setReading(self, sock, reading):
+        """
+        Pause or resume the read events of sock.
+        """
+        self.modify(sock, reading=reading)
+
+    def modify(self, sock, **changes):
+        try:
+            key = self.selector.get_key(sock)
+        except (KeyError, ValueError):
+            return
+
+        onRead, onWrite, reading = key.data
+        onWrite = changes.get("onWrite", onWrite)
+        reading = changes.get("reading", reading)
+
+        events = 0
+        if reading:
+            events |= selectors.EVENT_READ
+        if onWrite:
+            events |= selectors.EVENT_WRITE
+
+        # We can't watch for nothing, we're gonna ignore the read events instead.
+        self.selector.modify(sock, events or selectors.EVENT_READ, (onRead, onWrite, reading))
+
+    def isRegistered(self, key):
+        current = self.selector.get_map().get(key.fd)
+        return current is not None and current.fileobj is key.fileobj
+
+    def callSoon(self, callback):
+        """
+        Run callback at the end of the current tick, before we wait again.
+        """
+        self.pending.append(callback)
+
+    def addTimer(self, delay, callback, repeat=False):
+        """
+        Run callback in delay seconds, and every delay seconds after that if repeat is set.
+        """
+        timer = Timer(time.monotonic() + delay, callback, delay if repeat else None)
+        heapq.heappush(self.timers, (timer.deadline, next(self.timerSequence), timer))
+        return timer
+
+    def getTimeout(self):
+        if self.pending:
+            return 0
+
+        # We drop the cancelled timers so they don't wake us up for nothing
+        while self.timers and self.timers[0][2].cancelled:
+            heapq.heappop(self.timers)
+
+        if not self.timers:
+            return self.maxTimeout
+
+        return min(max(self.timers[0][0] - time.monotonic(), 0), self.maxTimeout)
+
+    def runTimers(self):
+        now = time.monotonic()
+        while self.timers and self.timers[0][0] <= now:
+            _, _, timer = heapq.heappop(self.timers)
+            if timer.cancelled:
+                continue
+
+            if timer.interval is not None:
+                timer.deadline += timer.interval
+                # We don't want to catch up on every missed tick if we were stalled.
+                if timer.deadline <= now:
+                    timer.deadline = now + timer.interval
+
+                heapq.heappush(self.timers, (timer.deadline, next(self.timerSequence), timer))
+
+            timer.callback()
+
+    def runPending(self):
+        # Callbacks may schedule new callbacks, they'll run on this tick too.
+        while self.pending:
+            pending, self.pending = self.pending, []
+            for callback in pending:
+                callback()
+
+    def poll(self, timeout=None):
+        """
+        Wait for socket events or timers, up to timeout seconds, and dispatch them.
+        """
+        if timeout is None:
+            timeout = self.getTimeout()
+
+        for key, mask in self.selector.select(timeout):
+            onRead, onWrite, reading = key.data
+            if mask & selectors.EVENT_WRITE and onWrite and self.isRegistered(key):
+                onWrite()
+
+            # A previous callback may have dropped or paused this socket.
+            if mask & selectors.EVENT_READ and reading and self.isRegistered(key):
+                onRead()
+
+        self.runTimers()
+        self.runPending()
+
+    def run(self):
+        """
+        Run forever
+        """
+        while True:
+            self.poll()
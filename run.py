@@ -1,4 +1,4 @@
-import subprocess, time, select, threading, sys, msvcrt, os
+import subprocess, time, select, threading, sys, msvcrt, os, signal
 
 lock = threading.Lock()
 focus = None
@@ -24,7 +24,9 @@ def reader(proc):
 otp, ud, ai, tt = None, None, None, None
 
 try:
-    otp = subprocess.Popen(["py", "-u", "py_otp.py"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, stdin=subprocess.PIPE)
+    # In its own process group, so we can ask it to stop with a CTRL_BREAK_EVENT and it saves the database.
+    otp = subprocess.Popen(["py", "-u", "py_otp.py"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, stdin=subprocess.PIPE,
+                           creationflags=subprocess.CREATE_NEW_PROCESS_GROUP)
     
     os.chdir("../ttsrc")
     ud = subprocess.Popen(["built/python/ppython", "-u", "ttrun.py", "-ud"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, stdin=subprocess.PIPE)
@@ -53,7 +55,14 @@ try:
             
         
 finally:
-    if otp: otp.terminate()
+    if otp:
+        # terminate() can't be caught on Windows, we give it some time to stop by itself first.
+        otp.send_signal(signal.CTRL_BREAK_EVENT)
+        try:
+            otp.wait(10)
+        except subprocess.TimeoutExpired:
+            otp.terminate()
+            
     if ud: ud.terminate()
     if ai: ai.terminate()
     if tt: tt.terminate()
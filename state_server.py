@@ -32,6 +32,12 @@ class StateServer:
         # Database Distributed Objects
         self.dbObjects = {}
         
+        # Where every object is, parentId -> zoneId -> set of doIds
+        self.locations = {}
+        
+        # Objects generated by each sender, sender -> set of doIds
+        self.owned = {}
+        
         # Format for object hierarchy:
         # doId, parentId, zoneId
 
@@ -41,72 +47,178 @@ class StateServer:
         self.objectServer.update("setName", "PyOTP")
         self.objectServer.update("setDcHash", 798635679)
         self.objectServer.update("setDateCreated", int(time.time()))
-        self.objects[self.objectServer.doId] = self.objectServer
+        self.addObject(self.objectServer)
         
         # CentralLogger
         # OTP_DO_ID_CENTRAL_LOGGER, OTP_DO_ID_SERVER_ROOT, OTP_ZONE_ID_INVALID
         self.centralLogger = CentralLogger(self.otp, 4688, self.dc.getClassByName("CentralLogger"), OTP_SERVER_ROOT_DO_ID, 0)
-        self.objects[self.centralLogger.doId] = self.centralLogger
+        self.addObject(self.centralLogger)
         
         # Make our game root for Toontown, OTP_DO_ID_TOONTOWN, OTP_DO_ID_SERVER_ROOT, OTP_ZONE_ID_MANAGEMENT
         self.toontownDirectory = DistributedDirectory(4618, self.dc.getClassByName("DistributedDirectory"), OTP_SERVER_ROOT_DO_ID, 2)
-        self.objects[self.toontownDirectory.doId] = self.toontownDirectory
+        self.addObject(self.toontownDirectory)
         
         # Make our global objects for Toontown.
         
         # OTP_DO_ID_TOONTOWN_SPEEDCHAT_RELAY, OTP_DO_ID_TOONTOWN, OTP_ZONE_ID_INVALID
         self.toontownSpeedchatRelay = DistributedObject(4712, self.dc.getClassByName("TTSpeedchatRelay"), 4618, 0)
-        self.objects[self.toontownSpeedchatRelay.doId] = self.toontownSpeedchatRelay
+        self.addObject(self.toontownSpeedchatRelay)
         
         # OTP_DO_ID_TOONTOWN_DELIVERY_MANAGER, OTP_DO_ID_TOONTOWN, OTP_ZONE_ID_INVALID
         self.toontownDeliveryManager = DistributedObject(4683, self.dc.getClassByName("DistributedDeliveryManager"), 4618, 0)
-        self.objects[self.toontownDeliveryManager.doId] = self.toontownDeliveryManager
+        self.addObject(self.toontownDeliveryManager)
         
         # OTP_DO_ID_TOONTOWN_MAIL_MANAGER, OTP_DO_ID_TOONTOWN, OTP_ZONE_ID_INVALID
         self.toontownMailManager = DistributedObject(4690, self.dc.getClassByName("DistributedMailManager"), 4618, 0)
-        self.objects[self.toontownMailManager.doId] = self.toontownMailManager
+        self.addObject(self.toontownMailManager)
         
         # OTP_DO_ID_TOONTOWN_PARTY_MANAGER, OTP_DO_ID_TOONTOWN, OTP_ZONE_ID_INVALID
         self.toontownPartyManager = DistributedObject(4691, self.dc.getClassByName("DistributedPartyManager"), 4618, 0)
-        self.objects[self.toontownPartyManager.doId] = self.toontownPartyManager
+        self.addObject(self.toontownPartyManager)
         
         if ConfigVariableBool('want-code-redemption', 1).getValue():
             # OTP_DO_ID_TOONTOWN_CODE_REDEMPTION_MANAGER, OTP_DO_ID_TOONTOWN, OTP_ZONE_ID_INVALID
             self.toontownCodeRedemptionManager = DistributedObject(4695, self.dc.getClassByName("TTCodeRedemptionMgr"), 4618, 0)
-            self.objects[self.toontownCodeRedemptionManager.doId] = self.toontownCodeRedemptionManager
+            self.addObject(self.toontownCodeRedemptionManager)
             
         # OTP_DO_ID_TOONTOWN_NON_REPEATABLE_RANDOM_SOURCE, OTP_DO_ID_TOONTOWN, OTP_ZONE_ID_INVALID
         self.toontownNonRepeatableRandomSource = DistributedObject(4697, self.dc.getClassByName("NonRepeatableRandomSource"), 4618, 0)
-        self.objects[self.toontownNonRepeatableRandomSource.doId] = self.toontownNonRepeatableRandomSource
+        self.addObject(self.toontownNonRepeatableRandomSource)
         
         if ConfigVariableBool('want-ddsm', 1).getValue():
             # OTP_DO_ID_TOONTOWN_TEMP_STORE_MANAGER, OTP_DO_ID_TOONTOWN, OTP_ZONE_ID_INVALID
             self.toontownDataStoreManager = DistributedObject(4684, self.dc.getClassByName("DistributedDataStoreManager"), 4618, 0)
-            self.objects[self.toontownDataStoreManager.doId] = self.toontownDataStoreManager
+            self.addObject(self.toontownDataStoreManager)
             
         # OTP_DO_ID_TOONTOWN_RAT_MANAGER, OTP_DO_ID_TOONTOWN, OTP_ZONE_ID_INVALID
         self.toontownRATManager = DistributedObject(4692, self.dc.getClassByName("RATManager"), 4618, 0)
-        self.objects[self.toontownRATManager.doId] = self.toontownRATManager
+        self.addObject(self.toontownRATManager)
         
         # OTP_DO_ID_TOONTOWN_AWARD_MANAGER, OTP_DO_ID_TOONTOWN, OTP_ZONE_ID_INVALID
         self.toontownAwardManager = DistributedObject(4694, self.dc.getClassByName("AwardManager"), 4618, 0)
-        self.objects[self.toontownAwardManager.doId] = self.toontownAwardManager
+        self.addObject(self.toontownAwardManager)
         
         # OTP_DO_ID_TOONTOWN_IN_GAME_NEWS_MANAGER, OTP_DO_ID_TOONTOWN, OTP_ZONE_ID_INVALID
         self.toontownInGameNewsMgr = DistributedObject(4696, self.dc.getClassByName("DistributedInGameNewsMgr"), 4618, 0)
-        self.objects[self.toontownInGameNewsMgr.doId] = self.toontownInGameNewsMgr
+        self.addObject(self.toontownInGameNewsMgr)
         
         # OTP_DO_ID_TOONTOWN_WHITELIST_MANAGER, OTP_DO_ID_TOONTOWN, OTP_ZONE_ID_INVALID
         self.toontownWhitelistManager = DistributedObject(4699, self.dc.getClassByName("DistributedWhitelistMgr"), 4618, 0)
-        self.objects[self.toontownWhitelistManager.doId] = self.toontownWhitelistManager
+        self.addObject(self.toontownWhitelistManager)
         
         # OTP_DO_ID_TOONTOWN_CPU_INFO_MANAGER, OTP_DO_ID_TOONTOWN, OTP_ZONE_ID_INVALID
         self.toontownCpuInfoManager = DistributedObject(4713, self.dc.getClassByName("DistributedCpuInfoMgr"), 4618, 0)
-        self.objects[self.toontownCpuInfoManager.doId] = self.toontownCpuInfoManager
+        self.addObject(self.toontownCpuInfoManager)
         
         # OTP_DO_ID_TOONTOWN_SECURITY_MANAGER, OTP_DO_ID_TOONTOWN, OTP_ZONE_ID_INVALID
         self.toontownSecurityManager = DistributedObject(4714, self.dc.getClassByName("DistributedSecurityMgr"), 4618, 0)
-        self.objects[self.toontownSecurityManager.doId] = self.toontownSecurityManager
+        self.addObject(self.toontownSecurityManager)
+        
+    def addObject(self, do, database=False):
+        """
+        Save an object and index its location
+        """
+        if database:
+            self.dbObjects[do.doId] = do
+        else:
+            self.objects[do.doId] = do
+            
+        self.addLocation(do)
+        
+    def removeObject(self, do):
+        if do.doId in self.dbObjects:
+            del self.dbObjects[do.doId]
+        else:
+            del self.objects[do.doId]
+            
+        self.removeLocation(do)
+        
+        # The doId might still be used by another object.
+        if self.getObject(do.doId) is None:
+            for sender in do.senders:
+                self.removeSender(do.doId, sender)
+        
+    def addSender(self, do, sender):
+        if not sender in do.senders:
+            do.senders += (sender,)
+        
+        if not sender in self.owned:
+            self.owned[sender] = set()
+            
+        self.owned[sender].add(do.doId)
+        
+    def removeSender(self, doId, sender):
+        owned = self.owned.get(sender)
+        if not owned:
+            return
+            
+        owned.discard(doId)
+        if not owned:
+            del self.owned[sender]
+        
+    def getObject(self, doId):
+        """
+        Get an object, database objects first, or None
+        """
+        if doId in self.dbObjects:
+            return self.dbObjects[doId]
+            
+        return self.objects.get(doId)
+        
+    def setObjectLocation(self, do, parentId, zoneId):
+        """
+        Move an object, keeping the location index up to date
+        """
+        self.removeLocation(do)
+        do.parentId = parentId
+        do.zoneId = zoneId
+        self.addLocation(do)
+        
+    def addLocation(self, do):
+        if not do.parentId in self.locations:
+            self.locations[do.parentId] = {}
+            
+        zones = self.locations[do.parentId]
+        if not do.zoneId in zones:
+            zones[do.zoneId] = set()
+            
+        zones[do.zoneId].add(do.doId)
+        
+    def removeLocation(self, do):
+        zones = self.locations.get(do.parentId)
+        if not zones or not do.zoneId in zones:
+            return
+            
+        # The doId might be indexed for another object with the same doId.
+        if self.getObject(do.doId) not in (None, do):
+            return
+            
+        zones[do.zoneId].discard(do.doId)
+        if not zones[do.zoneId]:
+            del zones[do.zoneId]
+            if not zones:
+                del self.locations[do.parentId]
+                
+    def getObjectsInZones(self, parentId, zones):
+        """
+        Get every object under parentId in one of these zones
+        """
+        locations = self.locations.get(parentId)
+        if not locations:
+            return []
+            
+        objects = []
+        for zoneId in zones:
+            for doId in locations.get(zoneId, ()):
+                objects.append(self.getObject(doId))
+                
+        return objects
+        
+    def getChildren(self, parentId):
+        """
+        Get every object under parentId, in any zone
+        """
+        return self.getObjectsInZones(parentId, self.locations.get(parentId, ()))
         
     def getInterested(self, do, sender):
         """
@@ -132,48 +244,131 @@ class StateServer:
         return list(channels)
         
         
-    def deleteObject(self, do, sender):
+    def receiveUpdates(self, do, sender, di, count):
         """
-        Delete an object and transmits the deletion
+        Apply count field updates read from di,
+        and get the field and packed data of each of them
+        """
+        # Handle internal CentralLogger specially.
+        if isinstance(do, CentralLogger):
+            updates = do.schema.readFields(di, count)
+            for field, data in updates:
+                do.logField(sender, field, data)
+                
+            return updates
+            
+        return do.receiveUpdates(di, count)
+        
+    def transmitUpdates(self, do, updates, sender, multiple=False):
+        """
+        Transmit field updates to the interested OTP clients and game clients.
+        The interest lookups are done once for all the fields.
         """
+        # We transmit the update if it was not sent by the owner
+        interested = self.getInterested(do, sender)
         
-        # Yeah no.
-        if not do:
-            return
+        # Get our uberDog client.
+        uberDog = self.messageDirector.getUberdog()
         
-        # We don't have the object in either! Nothing to do here.
-        if not do.doId in self.dbObjects and not do.doId in self.objects:
-            #print("Tried to delete do %d that wasn't in objects anymore!" % (do.doId))
-            return
-            
-        #print("Deleting do %d in objects!" % (do.doId))
+        # The fields going to the same channels are sent together.
+        groups = {}
+        for field, data in updates:
+            channels = list(interested)
             
-        if not do.doId in self.dbObjects:
-            assert self.objects[do.doId] == do, "wrong object"
+            # We did not implement airecv fields yet so let's do it.
+            for senderId in do.senders:
+                # First check for if the Uberdog should recieve the field,
+                # If not. Remove it.
+                if uberDog and (field.isClrecv() or field.isOwnrecv() or field.isAirecv()):
+                    uberDogChannel = uberDog.getPrimaryChannel()
+                    # Remove the uberdog channel if it's in the channels.
+                    if uberDogChannel in channels:
+                        channels.remove(uberDogChannel)
+                # If the AI isn't going to recieve it, Remove it.
+                if senderId in channels and not field.isAirecv():
+                    channels.remove(senderId)
+                    
+            # Don't send it back to yourself you fucking dumbass!
+            # We don't want any of your fucking infinite loops.
+            if do.doId in channels:
+                channels.remove(do.doId)
+            if sender in channels:
+                channels.remove(sender)
+                
+            if channels:
+                key = tuple(sorted(channels))
+                if not key in groups:
+                    groups[key] = []
+                    
+                groups[key].append((field, data))
+                
+        for channels, fieldUpdates in groups.items():
+            print(sender, do.doId, list(channels))
+            dg = Datagram()
+            dg.addUint32(do.doId)
             
-            # We can delete the object
-            del self.objects[do.doId]
-        else:
-            assert self.dbObjects[do.doId] == do, "wrong database object"
+            # We only send multiple fields to who sent us multiple fields.
+            if multiple:
+                dg.addUint16(len(fieldUpdates))
+                
+            for field, data in fieldUpdates:
+                dg.addUint16(field.getNumber())
+                dg.appendData(data)
+                
+            self.messageDirector.sendMessage(list(channels), sender, STATESERVER_OBJECT_UPDATE_FIELD_MULTIPLE if multiple else STATESERVER_OBJECT_UPDATE_FIELD, dg)
             
-            # We can delete the object
-            del self.dbObjects[do.doId]
+        # We announce to clients too (cause we're a ClientAgent)
+        self.clientAgent.announceUpdates(do, updates, sender)
         
-        # We should tell everyone the object is gone
-        # Write the delete ram packet
-        dg = Datagram()
-        dg.addUint32(do.doId)
+    def deleteObject(self, do, sender):
+        """
+        Delete an object and transmits the deletion
+        """
+        self.deleteObjects([do], sender)
         
-        # We send the update to the interested OTP clients
-        channels = self.getInterested(do, sender)
-        # We want to reflect the delete back to the AI, 
-        # Otherwise the deleted object channel in question will not be cleaned up.
-        channels.append(sender)
-        if channels:
-            self.messageDirector.sendMessage(channels, sender, STATESERVER_OBJECT_DELETE_RAM, dg)
+    def deleteObjects(self, objects, sender):
+        """
+        Delete objects and transmits the deletions,
+        game clients get them grouped by zone
+        """
+        deleted = []
+        for do in objects:
+            # Yeah no.
+            if not do:
+                continue
+            
+            # We don't have the object in either! Nothing to do here.
+            if not do.doId in self.dbObjects and not do.doId in self.objects:
+                #print("Tried to delete do %d that wasn't in objects anymore!" % (do.doId))
+                continue
+                
+            #print("Deleting do %d in objects!" % (do.doId))
+                
+            if not do.doId in self.dbObjects:
+                assert self.objects[do.doId] == do, "wrong object"
+            else:
+                assert self.dbObjects[do.doId] == do, "wrong database object"
+                
+            # We can delete the object
+            self.removeObject(do)
+            deleted.append(do)
+            
+            # We should tell everyone the object is gone
+            # Write the delete ram packet
+            dg = Datagram()
+            dg.addUint32(do.doId)
+            
+            # We send the update to the interested OTP clients
+            channels = self.getInterested(do, sender)
+            # We want to reflect the delete back to the AI, 
+            # Otherwise the deleted object channel in question will not be cleaned up.
+            channels.append(sender)
+            if channels:
+                self.messageDirector.sendMessage(channels, sender, STATESERVER_OBJECT_DELETE_RAM, dg)
         
         # We announce to game clients too (through ClientAgent)
-        self.clientAgent.announceDelete(do, sender)
+        if deleted:
+            self.clientAgent.announceDeletes(deleted, sender)
         
     def handle_object_channel(self, channel, sender, code, di):
         if channel in self.dbObjects:
@@ -192,9 +387,8 @@ class StateServer:
                 print("Got mismatching generate request for object %d, Object %d recieved it instead!" % (doId, do.doId))
                 return
             
-            do.parentId = parentId
-            do.zoneId = zoneId
-            do.senders.append(sender)
+            self.setObjectLocation(do, parentId, zoneId)
+            self.addSender(do, sender)
             
             #print("Generating %s object %d at (%d, %d)" % (do.dclass.getName(), do.doId, do.parentId, do.zoneId))
             
@@ -242,8 +436,8 @@ class StateServer:
             # It was sent directly to the object, which means it was found
             self.deleteObject(do, sender)
             
-        elif code == STATESERVER_OBJECT_UPDATE_FIELD:
-            # We are asked to update an object field.
+        elif code in (STATESERVER_OBJECT_UPDATE_FIELD, STATESERVER_OBJECT_UPDATE_FIELD_MULTIPLE):
+            # We are asked to update one or more object fields.
             
             # This packet can be sent to the StateServer
             # or the object channel.
@@ -251,63 +445,18 @@ class StateServer:
             # We must check if doId matches, and if it doesn't,
             # it means it was sent to the wrong channel or was meant for the SS channel.
             
-            # We are asked to update a field
+            # We are asked to update fields
             doId = di.getUint32()
-            fieldId = di.getUint16()
             
             # Is this sent to the correct object?
             if doId != do.doId:
                 raise Exception("Object %d does not match channel %d" % (doId, do.doId))
                 
-            # The remaining data is field data
-            data = di.getRemainingBytes()
-            
-            # We apply the update
-            field = do.dclass.getFieldByIndex(fieldId)
-            
-            # Handle internal CentralLogger specially.
-            if isinstance(do, CentralLogger):
-                do.receiveField(sender, field, di)
-            else:
-                do.receiveField(field, di)
-            
-            # We transmit the update if it was not sent by the owner
-            channels = self.getInterested(do, sender)
+            multiple = code == STATESERVER_OBJECT_UPDATE_FIELD_MULTIPLE
             
-            # Get our uberDog client.
-            uberDog = self.messageDirector.getUberdog()
-            
-            # We did not implement airecv fields yet so let's do it.
-            for senderId in do.senders:
-                # First check for if the Uberdog should recieve the field,
-                # If not. Remove it.
-                if uberDog and (field.isClrecv() or field.isOwnrecv() or field.isAirecv()):
-                    uberDogChannel = uberDog.getPrimaryChannel()
-                    # Remove the uberdog channel if it's in the channels.
-                    if uberDogChannel in channels:
-                        channels.remove(uberDogChannel)
-                # If the AI isn't going to recieve it, Remove it.
-                if senderId in channels and not field.isAirecv():
-                    channels.remove(senderId)
-                    
-            # Don't send it back to yourself you fucking dumbass!
-            # We don't want any of your fucking infinite loops.
-            if do.doId in channels:
-                channels.remove(do.doId)
-            if sender in channels:
-                channels.remove(sender)
-                
-            if channels:
-                print(sender, do.doId, channels)
-                dg = Datagram()
-                dg.addUint32(doId)
-                dg.addUint16(fieldId)
-                dg.appendData(data)
-                
-                self.messageDirector.sendMessage(channels, sender, STATESERVER_OBJECT_UPDATE_FIELD, dg)
-                
-            # We announce to clients too (cause we're a ClientAgent)
-            self.clientAgent.announceUpdate(do, field, data, sender)
+            # We apply the updates, then we transmit them
+            updates = self.receiveUpdates(do, sender, di, di.getUint16() if multiple else 1)
+            self.transmitUpdates(do, updates, sender, multiple)
             
         elif code == STATESERVER_QUERY_OBJECT_ALL:
             # Someone is asking info about us
@@ -335,8 +484,7 @@ class StateServer:
             prevParentId, prevZoneId = do.parentId, do.zoneId
             
             # We set the new zone
-            do.parentId = parentId
-            do.zoneId = zoneId
+            self.setObjectLocation(do, parentId, zoneId)
             
             # We announce the object was moved if it was not asked by the "owner"
             if do.parentId in self.objects and not sender in self.objects[do.parentId].senders:
@@ -392,16 +540,15 @@ class StateServer:
                 
                 # We create the object
                 do = DistributedObject(doId, dclass, parentId, zoneId)
-                do.senders.append(sender)
+                self.addSender(do, sender)
                 
                 # We save the object
-                self.dbObjects[doId] = do
+                self.addObject(do, True)
             else:
                 # We update the object
                 do = self.dbObjects[channel]
-                do.parentId = parentId
-                do.zoneId = zoneId
-                do.senders.append(sender)
+                self.setObjectLocation(do, parentId, zoneId)
+                self.addSender(do, sender)
             
                 if do.doId != doId:
                     print("A generate was sent for an incorrect database object!")
@@ -452,15 +599,14 @@ class StateServer:
                 
                 # We create the object
                 do = DistributedObject(doId, dclass, parentId, zoneId)
-                do.senders.append(sender)
+                self.addSender(do, sender)
                 
                 # We save the object
-                self.objects[doId] = do
+                self.addObject(do)
             else:
                 do = self.objects[doId]
-                do.parentId = parentId
-                do.zoneId = zoneId
-                do.senders.append(sender)
+                self.setObjectLocation(do, parentId, zoneId)
+                self.addSender(do, sender)
             
             #print("Generating %s object %d at (%d, %d) from %d" % (do.dclass.getName(), do.doId, do.parentId, do.zoneId, sender))
             
@@ -487,8 +633,8 @@ class StateServer:
             #print("Announcing Create for Object %d with sender %d!" % (do.doId, sender))
             self.clientAgent.announceCreate(do, sender)
             
-        elif code == STATESERVER_OBJECT_UPDATE_FIELD:
-            # We are asked to update an object field.
+        elif code in (STATESERVER_OBJECT_UPDATE_FIELD, STATESERVER_OBJECT_UPDATE_FIELD_MULTIPLE):
+            # We are asked to update one or more object fields.
             
             # This packet can be sent to the StateServer
             # or the object channel.
@@ -508,58 +654,11 @@ class StateServer:
             else:
                 do = self.objects[doId]
                 
-            # Now let's update our object field.
-            fieldId = di.getUint16()
-                
-            # The remaining data is field data
-            data = di.getRemainingBytes()
-            
-            # We apply the update
-            field = do.dclass.getFieldByIndex(fieldId)
-            
-            # Handle internal CentralLogger specially.
-            if isinstance(do, CentralLogger):
-                do.receiveField(sender, field, di)
-            else:
-                do.receiveField(field, di)
+            multiple = code == STATESERVER_OBJECT_UPDATE_FIELD_MULTIPLE
             
-            # We transmit the update if it was not sent by the owner
-            channels = self.getInterested(do, sender)
-            
-            # Get our uberDog client.
-            uberDog = self.messageDirector.getUberdog()
-            
-            # We did not implement airecv fields yet so let's do it.
-            for senderId in do.senders:
-                # First check for if the Uberdog should recieve the field,
-                # If not. Remove it.
-                if uberDog and (field.isClrecv() or field.isOwnrecv() or field.isAirecv()):
-                    uberDogChannel = uberDog.getPrimaryChannel()
-                    # Remove the uberdog channel if it's in the channels.
-                    if uberDogChannel in channels:
-                        channels.remove(uberDogChannel)
-                # If the AI isn't going to recieve it, Remove it.
-                if senderId in channels and not field.isAirecv():
-                    channels.remove(senderId)
-                    
-            # Don't send it back to yourself you fucking dumbass!
-            # We don't want any of your fucking infinite loops.
-            if do.doId in channels:
-                channels.remove(do.doId)
-            if sender in channels:
-                channels.remove(sender)
-
-            if channels:
-                print(sender, do.doId, channels)
-                dg = Datagram()
-                dg.addUint32(doId)
-                dg.addUint16(fieldId)
-                dg.appendData(data)
-                
-                self.messageDirector.sendMessage(channels, sender, STATESERVER_OBJECT_UPDATE_FIELD, dg)
-                
-            # We announce to clients too (cause we're a ClientAgent)
-            self.clientAgent.announceUpdate(do, field, data, sender)
+            # Now let's update our object fields, and transmit them.
+            updates = self.receiveUpdates(do, sender, di, di.getUint16() if multiple else 1)
+            self.transmitUpdates(do, updates, sender, multiple)
             
         elif code == STATESERVER_OBJECT_DELETE_RAM:
             # We are asked to delete an object.
@@ -598,19 +697,26 @@ class StateServer:
             # We get every object to delete,
             # which means we look for the objects created by this shard,
             # or every object parented to it.
+            owned = self.owned.get(shardId, set())
+            
             objects = []
-            for do in self.objects.values():
-                if shardId in do.senders or (do.parentId in self.objects and shardId in self.objects[do.parentId].senders):
-                    objects.append(do)
-
-            for do in self.dbObjects.values():
-                if shardId in do.senders or (do.parentId in self.dbObjects and shardId in self.dbObjects[do.parentId].senders):
+            for table in (self.objects, self.dbObjects):
+                for doId in owned:
+                    do = table.get(doId)
+                    if not do:
+                        continue
+                        
                     objects.append(do)
+                    
+                    # The children from the same table go with it,
+                    # unless the shard owns them too (then they're already in).
+                    for child in self.getChildren(doId):
+                        if table.get(child.doId) is child and not child.doId in owned:
+                            objects.append(child)
             
             # We got all the objects, we can now delete them.
             # The state server deletes the object, so we set the sender to ourself.
-            for do in objects:
-                self.deleteObject(do, self.ssId)
+            self.deleteObjects(objects, self.ssId)
                 
         elif code == STATESERVER_OBJECT_NOTFOUND:
             # Get the doId that was unsuccessfully found.
@@ -624,6 +730,12 @@ class StateServer:
         if di.getRemainingSize():
             raise Exception("Data remaining on stateserver: code %d has %d bytes left", (code, di.getRemainingBytes()))
         
+    def ownsChannel(self, channel):
+        """
+        Is this our channel or the channel of one of our objects?
+        """
+        return channel == self.ssId or channel in self.objects or channel in self.dbObjects
+        
     def handle(self, channels, sender, code, datagram):
         """
         Handle a message